@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+
+from argparse import ArgumentParser
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+ROOT = Path(__file__).resolve().parent
+TREE = ROOT / "tree"
+
+# always benchmark the chaqum next to us, not some installed one
+sys.path.insert(0, str(ROOT.parent))
+
+from chaqum.manager import Manager
+
+CASES = {
+    "spawn":     dict(num=500),
+    "tree":      dict(depth=2, width=20),
+    "admission": dict(depths=[0, 100, 1000], samples=200),
+    "commands":  dict(rounds=2000),
+    "messages":  dict(sizes=[16, 1024, 65536], count=2000),
+    "logging":   dict(lines=200000, length=80),
+    "memory":    dict(num=2000),
+}
+
+QUICK = {
+    "spawn":     dict(num=50),
+    "tree":      dict(depth=2, width=5),
+    "admission": dict(depths=[0, 100], samples=20),
+    "commands":  dict(rounds=200),
+    "messages":  dict(sizes=[16, 65536], count=200),
+    "logging":   dict(lines=20000, length=80),
+    "memory":    dict(num=200),
+}
+
+class DiscardHandler(logging.Handler):
+    # format but otherwise drop records to include the cost of log
+    # record creation and formatting without any output
+    def emit(self, record):
+        self.format(record)
+
+def setup_logging(verbose):
+    handler = logging.StreamHandler() if verbose else DiscardHandler()
+    handler.setFormatter(
+        logging.Formatter("{name:15} {levelname[0]}: [{job.ident}] {message}",
+                          style="{")
+    )
+    joblog = logging.getLogger("chaqum.job")
+    joblog.setLevel(logging.INFO)
+    joblog.addHandler(handler)
+    joblog.propagate = False
+    logging.getLogger("chaqum").setLevel(logging.WARNING)
+    logging.basicConfig()
+
+def setup_environ():
+    # jobs are not necessarily children of the manager (see -m
+    # fork_server=true), so tell them where to find it
+    os.environ["BENCHMARK_MANAGER_PID"] = str(os.getpid())
+
+    # job scripts need to find the same interpreter and chaqum
+    os.environ["PATH"] = os.pathsep.join(
+        (str(Path(sys.executable).parent), os.environ.get("PATH", ""))
+    )
+    os.environ["PYTHONPATH"] = os.pathsep.join(
+        filter(None, (str(ROOT.parent), os.environ.get("PYTHONPATH")))
+    )
+
+def run_case(case, params, manager_kws):
+    with TemporaryDirectory() as tmp:
+        output = Path(tmp) / "results.json"
+        mgr = Manager(TREE, **manager_kws)
+        asyncio.run(mgr.run(case, json.dumps(params), str(output)))
+
+        if not output.exists():
+            raise Exception(
+                f"Benchmark '{case}' produced no results; "
+                f"use -v to see its output."
+            )
+
+        return json.loads(output.read_text())
+
+def run(cases, repeat, manager_kws, quick):
+    results = {}
+
+    for case in cases:
+        params = (QUICK if quick else CASES)[case]
+        print(f"{case} ...", file=sys.stderr, flush=True)
+
+        # use the median over repeats to dampen outliers
+        runs = [run_case(case, params, manager_kws) for _ in range(repeat)]
+        for name,res in runs[0].items():
+            res.update(
+                value = statistics.median(r[name]["value"] for r in runs)
+            )
+            results[name] = res
+
+    return dict(
+        meta = dict(
+            time = time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            python = platform.python_version(),
+            platform = platform.platform(),
+            cpus = os.cpu_count(),
+            manager = manager_kws,
+            quick = quick,
+            repeat = repeat,
+        ),
+        results = results,
+    )
+
+def compare(baseline, current, threshold):
+    regressions = 0
+    rows = []
+
+    for name,cur in current["results"].items():
+        if (base := baseline["results"].get(name)) is None:
+            rows.append((name, "-", f"{cur['value']:.2f}", "", "new"))
+            continue
+
+        if base["value"]:
+            change = (cur["value"] - base["value"]) / base["value"]
+        else:
+            change = 0.0
+
+        worse = -change if cur["better"] == "higher" else change
+        note = ""
+        if worse > threshold:
+            regressions += 1
+            note = "REGRESSION"
+        elif -worse > threshold:
+            note = "improved"
+
+        rows.append((
+            name, f"{base['value']:.2f}", f"{cur['value']:.2f}",
+            f"{change:+.1%}", note,
+        ))
+
+    width = max(len(row[0]) for row in rows)
+    for name,base,cur,change,note in rows:
+        print(f"{name:{width}} {base:>12} {cur:>12} {change:>8} {note}")
+
+    return regressions
+
+def main():
+    parser = ArgumentParser(prog="run.py")
+    parser.add_argument(
+        "-o", "--output",
+        help="Write results as JSON to this file instead of stdout.",
+    )
+    parser.add_argument(
+        "-c", "--compare", metavar="BASELINE",
+        help=(
+            "Compare results against a JSON file written by an earlier "
+            "run. Exits non-zero if any benchmark regressed by more "
+            "than the threshold."
+        ),
+    )
+    parser.add_argument(
+        "-t", "--threshold", type=float, default=0.1,
+        help="Relative change counted as regression. Defaults to 0.1.",
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=3,
+        help="Number of runs per benchmark to take the median of.",
+    )
+    parser.add_argument(
+        "-q", "--quick", action="store_true",
+        help="Use much smaller workloads for a quick smoke test.",
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true",
+        help="Show the output of the benchmark jobs.",
+    )
+    parser.add_argument(
+        "-m", "--manager", metavar="KEY=VALUE", action="append", default=[],
+        help=(
+            "Keyword argument passed to the Manager constructor. Values "
+            "are parsed as JSON if possible. Can be repeated."
+        ),
+    )
+    parser.add_argument(
+        "cases", metavar="CASE", nargs="*",
+        help=f"Benchmarks to run. Defaults to all of: {', '.join(CASES)}.",
+    )
+    args = parser.parse_args()
+
+    for case in args.cases:
+        if case not in CASES:
+            parser.error(f"unknown benchmark '{case}'")
+
+    manager_kws = {}
+    for kw in args.manager:
+        key,_,value = kw.partition("=")
+        try:
+            manager_kws[key] = json.loads(value)
+        except ValueError:
+            manager_kws[key] = value
+
+    setup_logging(args.verbose)
+    setup_environ()
+
+    current = run(args.cases or CASES, args.repeat, manager_kws, args.quick)
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(current, fp, indent=2)
+    elif not args.compare:
+        json.dump(current, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as fp:
+            return 1 if compare(json.load(fp), current, args.threshold) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
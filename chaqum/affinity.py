@@ -0,0 +1,64 @@
+import os
+
+from pathlib import Path
+
+NODE_PATH = Path("/sys/devices/system/node")
+
+def parse_cpulist(spec):
+    # kernel style CPU list like "0-3,8,10-11"
+    cpus = []
+    for part in filter(None, spec.split(",")):
+        first,sep,last = part.partition("-")
+        if sep:
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(first))
+    if not cpus:
+        raise ValueError()
+    return cpus
+
+def numa_nodes():
+    # CPUs of every NUMA node we may run on; everything is one node
+    # if the system doesn't tell
+    available = os.sched_getaffinity(0)
+    nodes = []
+    for path in sorted(NODE_PATH.glob("node[0-9]*"),
+                       key=lambda path: int(path.name[4:])):
+        try:
+            cpus = parse_cpulist((path / "cpulist").read_text().strip())
+        except (OSError, ValueError):
+            continue
+        if cpus := [cpu for cpu in cpus if cpu in available]:
+            nodes.append(cpus)
+    return nodes or [sorted(available)]
+
+def _chunks(cpus, size):
+    return [cpus[i:i + size] for i in range(0, len(cpus), size)]
+
+def cpu_slots(spec, slots):
+    # Resolves a group's CPU specification to the CPU sets handed out
+    # to its jobs: an explicit list or 'pack'/'spread' across the NUMA
+    # nodes. With slots given, it is divided into that many sets so
+    # concurrent jobs don't share cores, either filling one node after
+    # the other (pack) or alternating between them (spread).
+    if spec in ("pack", "spread"):
+        nodes = numa_nodes()
+    else:
+        nodes = [parse_cpulist(spec)]
+
+    if not slots:
+        return [frozenset(cpu for cpus in nodes for cpu in cpus)]
+
+    size = max(1, sum(len(cpus) for cpus in nodes) // slots)
+    per_node = [_chunks(cpus, size) for cpus in nodes]
+
+    if spec == "spread":
+        chunks = [
+            node[i] for i in range(max(len(node) for node in per_node))
+            for node in per_node if i < len(node)
+        ]
+    else:
+        chunks = [chunk for node in per_node for chunk in node]
+
+    # more slots than cores: share them round robin
+    return [frozenset(chunks[i % len(chunks)]) for i in range(slots)]
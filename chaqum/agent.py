@@ -0,0 +1,268 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+
+from .remote import (
+    CMD,
+    EXIT,
+    HELLO,
+    KILL,
+    OUTPUT,
+    REPLY,
+    SPAWN,
+    STARTED,
+    TOKEN_VAR,
+    open_connection,
+    read_frame,
+    read_token,
+    write_frame,
+)
+from .spawn import (
+    signal_group,
+    spawn_local,
+)
+from .util import (
+    path_is_dir,
+    path_is_executable,
+    path_is_file,
+)
+
+log = logging.getLogger("chaqum.agent")
+
+class RemoteJob:
+    __slots__ = ("proc", "wr", "signal")
+
+    def __init__(self):
+        self.proc = None
+        self.wr = None
+        self.signal = None
+
+class Agent:
+    # Connects to a manager, announces its capacity and labels and
+    # runs the jobs it is sent from its own copy of the job tree,
+    # forwarding their output and commands.
+    def __init__(self, path, address, capacity, labels=(), name=None,
+                 token=None):
+        self._path = path_is_dir(path)
+        self._address = address
+        self._capacity = capacity
+        self._labels = list(labels)
+        self._name = name or os.uname().nodename
+        self._token = token
+        self._env = os.environ.copy()
+        self._env.pop(TOKEN_VAR, None)
+        self._writer = None
+        self._jobs = None
+
+    def _send(self, kind, channel, payload=b""):
+        if not self._writer.is_closing():
+            write_frame(self._writer, kind, channel, payload)
+
+    async def _drain(self):
+        try:
+            await self._writer.drain()
+        except ConnectionError:
+            pass
+
+    async def run(self):
+        reader,self._writer = await open_connection(self._address)
+        self._jobs = {}
+        tasks = set()
+
+        log.info(f"Connected to manager at '{self._address}'.")
+
+        self._send(HELLO, 0, dict(
+            name=self._name, labels=self._labels, capacity=self._capacity,
+            **{} if self._token is None else dict(token=self._token),
+        ))
+
+        try:
+            while True:
+                kind,channel,payload = await read_frame(reader)
+
+                if kind == SPAWN:
+                    job = self._jobs[channel] = RemoteJob()
+                    task = asyncio.create_task(
+                        self._run_job(channel, job, json.loads(payload))
+                    )
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+                elif (job := self._jobs.get(channel)) is None:
+                    continue
+
+                elif kind == REPLY:
+                    job.wr.write(payload)
+
+                elif kind == KILL:
+                    job.signal = json.loads(payload)["signal"]
+                    if job.proc is not None:
+                        signal_group(job.proc, job.signal)
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            log.info("Connection to manager closed.")
+
+        finally:
+            for job in self._jobs.values():
+                if job.proc is not None:
+                    signal_group(job.proc, signal.SIGTERM)
+            if tasks:
+                await asyncio.wait(tasks)
+            self._writer.close()
+
+    async def _pump(self, kind, channel, rd):
+        while data := await rd.read(65536):
+            self._send(kind, channel, data)
+            await self._drain()
+        self._send(kind, channel)
+
+    async def _run_job(self, channel, job, req):
+        try:
+            script = path_is_executable(path_is_file(self._path / req["script"]))
+            job.proc,rd,job.wr = await spawn_local(
+                (script, *req["args"]), self._path,
+                {**self._env, **req["env"]},
+            )
+        except OSError as exc:
+            del self._jobs[channel]
+            self._send(STARTED, channel, dict(
+                errno=exc.errno, error=exc.strerror or str(exc),
+            ))
+            return
+
+        log.info(f"Started '{req['script']}' with pid {job.proc.pid}.")
+        self._send(STARTED, channel, dict(pid=job.proc.pid))
+
+        # the manager asked to kill it before we got around to start it
+        if job.signal is not None:
+            signal_group(job.proc, job.signal)
+
+        try:
+            await asyncio.gather(
+                self._pump(OUTPUT, channel, job.proc.stdout),
+                self._pump(CMD, channel, rd),
+            )
+            returncode = await job.proc.wait()
+        finally:
+            del self._jobs[channel]
+            job.wr.close()
+
+        self._send(EXIT, channel, dict(returncode=returncode))
+        await self._drain()
+
+def main():
+    from argparse import ArgumentParser
+    from sys import stderr
+
+    prog = "chaqum-agent"
+    parser = ArgumentParser(prog=prog)
+    parser.add_argument(
+        "-v", "--verbose",
+        action="store_true",
+        help="Log started jobs and connection changes to stderr."
+    )
+    parser.add_argument(
+        "-c", "--capacity",
+        type=int,
+        default=os.cpu_count(),
+        help=(
+            "Number of jobs to run at the same time. Defaults to the "
+            "number of CPUs."
+        )
+    )
+    parser.add_argument(
+        "-l", "--label",
+        action="append",
+        default=[],
+        help=(
+            "Label to advertise to the manager. Groups targeting this "
+            "label may run their jobs here. Can be repeated."
+        )
+    )
+    parser.add_argument(
+        "-n", "--name",
+        help=(
+            "Name of this agent; also counts as a label. Defaults to "
+            "the hostname."
+        )
+    )
+    parser.add_argument(
+        "-r", "--retry", metavar="SECONDS",
+        type=float,
+        help=(
+            "Reconnect after SECONDS if the connection fails or is "
+            "closed instead of exiting."
+        )
+    )
+    parser.add_argument(
+        "-t", "--token-file", metavar="FILE",
+        help=(
+            "Present the token on the first line of FILE to the manager. "
+            "Defaults to the CHAQUM_AGENT_TOKEN environment variable."
+        )
+    )
+    parser.add_argument(
+        "address",
+        metavar="ADDRESS",
+        help=(
+            "Address the manager listens on; either HOST:PORT or the "
+            "path of a unix socket."
+        )
+    )
+    parser.add_argument(
+        "directory",
+        metavar="DIRECTORY",
+        help="Path to the local copy of the manager's job tree."
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format=f"{prog}: %(message)s",
+    )
+
+    try:
+        agent = Agent(
+            path = args.directory,
+            address = args.address,
+            capacity = args.capacity,
+            labels = args.label,
+            name = args.name,
+            token = read_token(args.token_file),
+        )
+
+    except Exception as exc:
+        print(f"{prog}: {exc}", file=stderr, flush=True)
+        return 1
+
+    async def run():
+        task = asyncio.current_task()
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, task.cancel
+        )
+
+        while True:
+            try:
+                await agent.run()
+            except OSError as exc:
+                log.error(f"Connecting to '{args.address}' failed: {exc}")
+                if args.retry is None:
+                    return 1
+
+            if args.retry is None:
+                return 0
+
+            await asyncio.sleep(args.retry)
+
+    try:
+        return asyncio.run(run())
+
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        return 0
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
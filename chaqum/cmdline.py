@@ -10,6 +10,7 @@ def main():
     from sys import stdin,stdout,stderr
 
     from .manager import Manager
+    from .remote import read_token
     from .util import (
         path_is_file,
         path_is_missing,
@@ -58,6 +59,93 @@ def main():
             "Defaults to 'entry'."
         )
     )
+    parser.add_argument(
+        "-s", "--scheduler",
+        default="builtin",
+        choices=("builtin", "apscheduler"),
+        help=(
+            "Select the scheduler used for repeats. 'apscheduler' "
+            "requires the optional APScheduler package. Defaults to "
+            "'builtin'."
+        )
+    )
+    parser.add_argument(
+        "-t", "--trace", metavar="FILE",
+        help=(
+            "Record job state changes, commands and messages and write "
+            "them as Chrome trace event JSON to FILE on shutdown or "
+            "when receiving SIGUSR1."
+        )
+    )
+    parser.add_argument(
+        "-f", "--fork-server",
+        action="store_true",
+        help=(
+            "Spawn jobs from a small helper process forked at startup "
+            "instead of from the job manager itself. Keeps spawning "
+            "fast and off the event loop once the manager has grown."
+        )
+    )
+    parser.add_argument(
+        "-L", "--listen", metavar="ADDRESS",
+        help=(
+            "Accept connections from chaqum-agent on ADDRESS, either "
+            "HOST:PORT or the path of a unix socket. Jobs of groups "
+            "with a label run on the agents advertising it. Without a "
+            "HOST only the loopback interface is used."
+        )
+    )
+    parser.add_argument(
+        "--token-file", metavar="FILE",
+        help=(
+            "Only accept agents presenting the token on the first line "
+            "of FILE. Defaults to the CHAQUM_AGENT_TOKEN environment "
+            "variable. Required when listening on HOST:PORT."
+        )
+    )
+    parser.add_argument(
+        "--retain-jobs", metavar="NUM", type=int, default=1000,
+        help=(
+            "Keep at most NUM finished but not yet awaited jobs in full "
+            "and replace older ones by compact records holding only "
+            "their exit code and timing. Defaults to 1000."
+        )
+    )
+    parser.add_argument(
+        "--retain-ttl", metavar="SECONDS", type=float,
+        help=(
+            "Also replace finished jobs by compact records after "
+            "SECONDS have passed."
+        )
+    )
+    parser.add_argument(
+        "--retain-tombstones", metavar="NUM", type=int, default=100000,
+        help=(
+            "Keep at most NUM compact records of finished jobs and "
+            "forget the least recently used ones. Defaults to 100000."
+        )
+    )
+    parser.add_argument(
+        "--kill-grace", metavar="SECONDS", type=float, default=5.0,
+        help=(
+            "Time given to the process group of a terminated or timed "
+            "out job to exit after SIGTERM before it is sent SIGKILL. "
+            "Defaults to 5."
+        )
+    )
+    parser.add_argument(
+        "--result-size", metavar="BYTES", type=int, default=1 << 20,
+        help=(
+            "Refuse job results larger than BYTES. Defaults to 1048576."
+        )
+    )
+    parser.add_argument(
+        "--result-spool", metavar="BYTES", type=int, default=1 << 16,
+        help=(
+            "Keep job results of up to BYTES in memory and spool larger "
+            "ones to a temporary file. Defaults to 65536."
+        )
+    )
     parser.add_argument(
         "directory",
         metavar="DIRECTORY",
@@ -84,6 +172,17 @@ def main():
         mgr = Manager(
             path = args.directory,
             entry_script_name = args.entry,
+            scheduler = args.scheduler,
+            trace = args.trace,
+            retain_jobs = args.retain_jobs,
+            retain_ttl = args.retain_ttl,
+            retain_tombstones = args.retain_tombstones,
+            result_size = args.result_size,
+            result_spool = args.result_spool,
+            kill_grace = args.kill_grace,
+            fork_server = args.fork_server,
+            listen = args.listen,
+            token = read_token(args.token_file),
         )
 
         # configure logging
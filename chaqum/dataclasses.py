@@ -1,39 +1,120 @@
 import asyncio
+import os
+import tempfile
+import time
 
-from collections import deque
+from collections import OrderedDict,deque
 from dataclasses import dataclass
 from enum import Enum
+from pathlib import Path
 from logging import getLogger,LoggerAdapter
 from psutil import cpu_percent
 
+from .affinity import cpu_slots
+from .priority import Priority
 from .util import run_once
 
 log = getLogger("chaqum.job")
 
 class JobState(Enum):
     INIT     = 1
-    WAITING  = 2
-    STARTING = 3
-    RUNNING  = 4
-    DONE     = 5
+    BLOCKED  = 2
+    WAITING  = 3
+    STARTING = 4
+    RUNNING  = 5
+    DONE     = 6
+
+class DependencyFailed(Exception):
+    pass
+
+class QueueFull(Exception):
+    pass
 
 class Job:
-    def __init__(self, loop, ident, parent, script, *args):
+    __slots__ = (
+        "loop", "ident", "parent", "script", "args", "after",
+        "after_success", "key", "key_ttl", "timeout", "tracer", "exitcode",
+        "task", "batch", "cpus",
+        "state", "started", "finished",
+        "_log", "_state_waiters", "_msg_inbox", "_msg_waiters",
+        "result", "_completions",
+    )
+
+    def __init__(self, loop, ident, parent, script, *args,
+                 after=(), after_success=False, key=None, key_ttl=None,
+                 timeout=None, tracer=None):
         self.loop = loop
         self.ident = ident
         self.parent = parent
         self.script = script
         self.args = args
+        self.after = after
+        self.after_success = after_success
+        self.key = key
+        self.key_ttl = key_ttl
+        self.timeout = timeout
+        self.tracer = tracer
         self.exitcode = None
         self.task = None
+        self.batch = None
+        self.cpus = None
         self.state = JobState.INIT
-        self.log = LoggerAdapter(log, extra=dict(job=self))
+        self.started = None
+        self.finished = None
+        self.result = None
+
+        # allocated on first use; most jobs never need some of them
+        self._log = None
+        self._state_waiters = None
+        self._msg_inbox = None
+        self._msg_waiters = None
+        self._completions = None
+
+        if tracer is not None:
+            tracer.state(self)
+
+    @property
+    def log(self):
+        if self._log is None:
+            self._log = LoggerAdapter(log, extra=dict(job=self))
+        return self._log
+
+    def set_result(self, data, spool_size, spool_dir):
+        # small results stay in memory, larger ones go to a file in
+        # spool_dir that is only open while being written or read
+        self.drop_result()
+        if len(data) > spool_size:
+            fd,path = tempfile.mkstemp(prefix="result-", dir=spool_dir)
+            with open(fd, "wb") as fp:
+                fp.write(data)
+            self.result = Path(path)
+        else:
+            self.result = data
+
+    def get_result(self):
+        if self.result is None or isinstance(self.result, bytes):
+            return self.result
+        return self.result.read_bytes()
+
+    def drop_result(self):
+        if self.result is not None and not isinstance(self.result, bytes):
+            self.result.unlink(missing_ok=True)
+        self.result = None
+
+    @property
+    def parent_ident(self):
+        return None if self.parent is None else self.parent.ident
+
+    @property
+    def is_queued(self):
+        # not started yet
+        return self.state in (
+            JobState.INIT, JobState.BLOCKED, JobState.WAITING
+        )
 
-        self._state_waiters = {
-            state: deque() for state in JobState
-        }
-        self._msg_inbox = deque()
-        self._msg_waiters = deque()
+    @property
+    def is_blocked(self):
+        return self.state == JobState.BLOCKED
 
     @property
     def is_waiting(self):
@@ -56,13 +137,19 @@ class Job:
             return
 
         self.state = newstate
-        waiters = self._state_waiters[newstate]
 
-        for fut in waiters:
+        if self.tracer is not None:
+            self.tracer.state(self)
+
+        if not self._state_waiters:
+            return
+
+        for fut in self._state_waiters.pop(newstate, ()):
             if not fut.cancelled():
                 fut.set_result(True)
 
-        waiters.clear()
+    def set_blocked(self):
+        self.set_state(JobState.BLOCKED)
 
     def set_waiting(self):
         self.set_state(JobState.WAITING)
@@ -71,9 +158,11 @@ class Job:
         self.set_state(JobState.STARTING)
 
     def set_running(self):
+        self.started = time.monotonic()
         self.set_state(JobState.RUNNING)
 
     def set_done(self):
+        self.finished = time.monotonic()
         self.set_state(JobState.DONE)
 
     def terminate(self):
@@ -85,7 +174,9 @@ class Job:
         if to == self.state:
             fut.set_result(True)
         else:
-            self._state_waiters[to].append(fut)
+            if self._state_waiters is None:
+                self._state_waiters = {}
+            self._state_waiters.setdefault(to, deque()).append(fut)
         return fut
 
     def wait_running(self):
@@ -94,11 +185,27 @@ class Job:
     def wait_done(self):
         return self._state_changed(JobState.DONE)
 
+    async def wait_dependencies(self):
+        if not self.after:
+            return
+
+        self.set_blocked()
+        self.log.info("Waiting for dependencies.")
+
+        # drop the references to the dependencies as soon as they are
+        # done; they might be huge
+        after,self.after = self.after,()
+        await asyncio.wait([job.wait_done() for job in after])
+
+        if self.after_success:
+            for job in after:
+                if job.exitcode != 0:
+                    raise DependencyFailed(job.ident)
+
     def _collect_message(self, result, was_collected, msg):
         if not was_collected.cancelled():
             was_collected.set_result(True)
-        if not result.cancelled():
-            result.set_result(msg)
+        result.set_result(msg)
 
     def collect_message(self):
         result = self.loop.create_future()
@@ -106,36 +213,218 @@ class Job:
         if self._msg_inbox:
             self._collect_message(result, *self._msg_inbox.popleft())
         else:
+            if self._msg_waiters is None:
+                self._msg_waiters = deque()
             self._msg_waiters.append(result)
 
         return result
 
+    def take_messages(self, limit):
+        # up to limit more queued messages, without waiting
+        msgs = []
+        while self._msg_inbox and len(msgs) < limit:
+            was_collected,msg = self._msg_inbox.popleft()
+            if not was_collected.cancelled():
+                was_collected.set_result(True)
+            msgs.append(msg)
+        return msgs
+
     def enqueue_message(self, msg):
         was_collected = self.loop.create_future()
 
-        if self._msg_waiters:
-            self._collect_message(
-                self._msg_waiters.popleft(), was_collected, msg
-            )
-        else:
-            self._msg_inbox.append((was_collected, msg))
+        # skip receivers that timed out or went away; the message
+        # would be lost on them
+        while self._msg_waiters:
+            if not (result := self._msg_waiters.popleft()).cancelled():
+                self._collect_message(result, was_collected, msg)
+                return was_collected
+
+        if self._msg_inbox is None:
+            self._msg_inbox = deque()
+        self._msg_inbox.append((was_collected, msg))
 
         return was_collected
 
+    def add_child(self):
+        if self._completions is None:
+            self._completions = Completions()
+        self._completions.pending += 1
+
+    def child_done(self, child):
+        cmpl = self._completions
+        cmpl.pending -= 1
+        cmpl.done[child.ident] = child.exitcode
+
+        while cmpl.waiters:
+            if not (fut := cmpl.waiters.popleft()).done():
+                fut.set_result(True)
+                break
+
+    def forget_child(self, ident):
+        if self._completions is not None:
+            self._completions.done.pop(ident, None)
+
+    def wait_child_done(self):
+        # future resolved as soon as a completed child can be taken;
+        # None if there is no child left that could complete
+        if (cmpl := self._completions) is None:
+            return None
+
+        fut = self.loop.create_future()
+        if cmpl.done:
+            fut.set_result(True)
+        elif cmpl.pending:
+            cmpl.waiters.append(fut)
+        else:
+            return None
+        return fut
+
+    def take_done_children(self, limit):
+        done = self._completions.done
+        return [done.popitem(last=False) for _ in range(min(limit, len(done)))]
+
+# completed children of a job in the order they finished, until they
+# are taken by nextdone
+class Completions:
+    __slots__ = ("pending", "done", "waiters")
+
+    def __init__(self):
+        self.pending = 0
+        self.done = OrderedDict()
+        self.waiters = deque()
+
+# compact record of a finished job kept after the full Job object was
+# evicted by the managers retention policy
+class JobTombstone:
+    __slots__ = ("ident", "parent_ident", "exitcode", "started", "finished")
+
+    state = JobState.DONE
+    is_done = True
+    result = None
+
+    def __init__(self, job):
+        self.ident = job.ident
+        self.parent_ident = job.parent_ident
+        self.exitcode = job.exitcode
+        self.started = job.started
+        self.finished = job.finished
+
+    def terminate(self):
+        pass
+
+    def forget_child(self, ident):
+        pass
+
+    def get_result(self):
+        return None
+
+    def drop_result(self):
+        pass
+
+    def wait_done(self):
+        fut = asyncio.get_running_loop().create_future()
+        fut.set_result(True)
+        return fut
+
+    def enqueue_message(self, msg):
+        raise Exception(f"Job '{self.ident}' is done.")
+
 @dataclass
 class GroupConfig:
     ident: str = None
     max_jobs: int = 0
     max_cpu: float = 0.0
+    cpu_window: float = 0.0
+    env: dict = None
+    label: str = None
+    rate: float = 0.0
+    burst: int = 0
+    batch: tuple = None
+    cpus: str = None
+    nice: int = None
+    ioclass: tuple = None
+    policy: str = None
+    max_queued: int = 0
+
+class TokenBucket:
+    # allows rate starts per second on average and up to burst of
+    # them at once
+    def __init__(self, loop, rate, burst):
+        self.loop = loop
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = loop.time()
+
+    def _refill(self):
+        now = self.loop.time()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.stamp) * self.rate
+        )
+        self.stamp = now
+
+    def ready(self):
+        self._refill()
+        return self.tokens >= 1
+
+    async def take(self):
+        # sleep until the next token is due instead of polling
+        while not self.ready():
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+        self.tokens -= 1
 
 class Group(dict):
-    def __init__(self, loop, stats, config):
+    def __init__(self, loop, stats, config, env):
         self.loop = loop
         self.stats = stats
         self.ident = config.ident
 
+        # environment template for jobs in this group; only copied if
+        # the group overrides something
+        self.env = {**env, **config.env} if config.env else env
+
+        # jobs of labeled groups run on remote agents; those only get
+        # the overrides and use their own environment otherwise
+        self.label = config.label
+        self.timeouts = 0
+        self.env_overrides = config.env or {}
+
+        # batching groups run their jobs as one process per script
+        # with the arguments of up to batch_size of them
+        self.batch_size,self.batch_wait = config.batch or (0, 0.0)
+        self.batches = {}
+
+        # scheduling settings for the job processes
+        self.priority = None
+        if any(v is not None for v in (config.nice, config.ioclass,
+                                        config.policy)):
+            ioclass,iolevel = config.ioclass or (None, 0)
+            self.priority = Priority(
+                config.nice, ioclass, iolevel, config.policy
+            )
+
+        # CPU sets handed out to the jobs, one per slot if the number
+        # of jobs is limited
+        self._cpu_slots = None
+        self._cpu_used = set()
+
+        if config.cpus:
+            self._cpu_slots = cpu_slots(config.cpus, config.max_jobs)
+            if not set().union(*self._cpu_slots) <= os.sched_getaffinity(0):
+                raise Exception(f"CPUs '{config.cpus}' not available.")
+
+        # producers enqueueing while max_queued jobs of the group have
+        # yet to start are held back; a batch counts by its jobs. Space
+        # is reserved for woken producers until they enqueue, so no
+        # newcomer can take it first.
+        self.max_queued = config.max_queued
+        self.queued = 0
+        self.reserved = 0
+        self._producers = deque()
+
         self._jobs_cond = None
         self._stats_cond = None
+        self._bucket = None
         self._queue = None
 
         if config.max_jobs:
@@ -145,15 +434,90 @@ class Group(dict):
 
         if config.max_cpu:
             self._stats_cond = lambda: all((
-                self.stats.cpu_percent < config.max_cpu,
+                self.stats.cpu_average(config.cpu_window) < config.max_cpu,
             ))
 
-        if self._jobs_cond or self._stats_cond:
+        if config.rate:
+            self._bucket = TokenBucket(
+                loop, config.rate, max(config.burst, 1)
+            )
+
+        if self._jobs_cond or self._stats_cond or self._bucket:
             self._queue = deque()
 
+    def _assign_cpus(self, job):
+        if self._cpu_slots is None:
+            return
+
+        if len(self._cpu_slots) == 1:
+            job.cpus = self._cpu_slots[0]
+            return
+
+        index = next(
+            (i for i in range(len(self._cpu_slots))
+             if i not in self._cpu_used),
+            None
+        )
+        if index is None:
+            # only with jobs of this group started elsewhere
+            job.cpus = self._cpu_slots[0]
+            return
+
+        self._cpu_used.add(index)
+        job.cpus = self._cpu_slots[index]
+        job.wait_done().add_done_callback(
+            lambda fut: self._cpu_used.discard(index)
+        )
+
+    @property
+    def is_full(self):
+        return (
+            bool(self.max_queued) and
+            self.queued + self.reserved >= self.max_queued
+        )
+
+    def wait_space(self):
+        # resolved once a queued job started; producers are woken in
+        # the order they came with space reserved for them
+        fut = self.loop.create_future()
+        self._producers.append(fut)
+        return fut
+
+    def claim_space(self):
+        # a woken producer is about to enqueue into its reserved space
+        self.reserved -= 1
+
+    def release_space(self):
+        # a woken producer gave up, the next one may have the space
+        self.reserved -= 1
+        self.wake_producers()
+
+    def enqueued(self):
+        self.queued += 1
+
+    def dequeued(self):
+        # a job started or was dropped before
+        self.queued -= 1
+        self.wake_producers()
+
+    def wake_producers(self):
+        # as many as there is space for, in the order they came
+        if not self._producers:
+            return
+
+        space = self.max_queued - self.queued - self.reserved
+        while self._producers and space > 0:
+            if not (fut := self._producers.popleft()).cancelled():
+                fut.set_result(True)
+                self.reserved += 1
+                space -= 1
+
     async def acquire_slot(self, job):
         if self._queue is None:
-            job.set_running()
+            self._assign_cpus(job)
+            job.set_starting()
+            if job.batch is None:
+                self.dequeued()
             return
 
         job.set_waiting()
@@ -177,6 +541,7 @@ class Group(dict):
             runnung_jobs = [
                 job for job in self.values()
                 if job.state in (JobState.STARTING, JobState.RUNNING)
+                and (job.batch is None or job is job.batch.job)
             ]
 
             if not self._jobs_cond(len(runnung_jobs)):
@@ -192,15 +557,61 @@ class Group(dict):
             log()
             await self.stats.notify_when(self._stats_cond)
 
+        # Do we need to wait for the start rate to allow another one?
+        # Done last so the token isn't spent while waiting for
+        # something else.
+        if self._bucket:
+            if not self._bucket.ready():
+                log()
+            await self._bucket.take()
+
         # We got ourselves a slot.
-        job.set_running()
+        self._assign_cpus(job)
+        job.set_starting()
+        if job.batch is None:
+            self.dequeued()
 
         # Make the queue advance.
         if not (fut := self._queue.popleft()).cancelled():
             fut.set_result(True)
 
-@dataclass
+class Batch:
+    # jobs of a batching group collected to be run as one process
+    __slots__ = ("script", "items", "statuses", "done", "timer", "job")
+
+    def __init__(self, loop, script):
+        self.script = script
+        self.items = []
+        self.statuses = {}
+        self.done = loop.create_future()
+        self.timer = None
+        self.job = None
+
+    @property
+    def args(self):
+        return tuple(arg for item in self.items for arg in item.args)
+
+class Repeat:
+    def __init__(self, ident, script, args, overlap=None):
+        self.ident = ident
+        self.script = script
+        self.args = args
+        self.overlap = overlap
+        self.job = None
+        self.pending = False
+        self.fired = 0
+        self.started = 0
+        self.skipped = 0
+        self.coalesced = 0
+
+    @property
+    def is_active(self):
+        return self.job is not None and not self.job.is_done
+
 class Message:
-    ident: str
-    data: bytes
-    delivered: asyncio.Future = None
+    __slots__ = ("ident", "data", "delivered")
+
+    def __init__(self, ident, data, delivered=None):
+        self.ident = ident
+        self.data = data
+        self.delivered = delivered
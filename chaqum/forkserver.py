@@ -0,0 +1,363 @@
+import asyncio
+import errno
+import itertools
+import json
+import logging
+import os
+import selectors
+import signal
+import socket
+import sys
+import traceback
+
+from array import array
+from dataclasses import astuple
+
+from .priority import (
+    Priority,
+)
+from .spawn import (
+    command_pipes,
+    connect_command_fds,
+    connect_read_fd,
+)
+from .util import (
+    get_max_fd,
+    move_fd_above,
+)
+
+log = logging.getLogger("chaqum.forkserver")
+
+# upper bounds for a single datagram and the fds passed along with it
+MAX_MESSAGE = 1 << 20
+MAX_FDS = 4
+
+# pidfd_send_signal flag for the process group of the pidfd's process,
+# since Linux 6.9
+PIDFD_SIGNAL_PROCESS_GROUP = 1 << 2
+
+def _send(sock, msg, fds=()):
+    anc = []
+    if fds:
+        anc.append((socket.SOL_SOCKET, socket.SCM_RIGHTS, array("i", fds)))
+    sock.sendmsg([json.dumps(msg).encode()], anc)
+
+def _recv(sock):
+    data,anc,_,_ = sock.recvmsg(MAX_MESSAGE, socket.CMSG_SPACE(MAX_FDS * 4))
+    fds = array("i")
+    for level,kind,payload in anc:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(payload[:len(payload) - len(payload) % fds.itemsize])
+    return (json.loads(data) if data else None), list(fds)
+
+def _exitcode(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+class _Server:
+    # runs in the forked helper process: a plain blocking loop without
+    # asyncio, spawning jobs on request and reporting their exit
+    def __init__(self, sock):
+        self._sock = sock
+        self._cwd = None
+
+    def run(self):
+        # get rid of everything inherited from the manager except for
+        # our socket and the standard streams
+        sockfd = self._sock.fileno()
+        os.closerange(3, sockfd)
+        os.closerange(sockfd + 1, get_max_fd())
+
+        # interrupts from the terminal are the manager's business; it
+        # shuts us down by closing the socket
+        for sig in (signal.SIGTERM, signal.SIGHUP,
+                    signal.SIGUSR1, signal.SIGUSR2):
+            signal.signal(sig, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        wake_rd,wake_wr = os.pipe()
+        os.set_blocking(wake_rd, False)
+        os.set_blocking(wake_wr, False)
+        signal.set_wakeup_fd(wake_wr)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        sel = selectors.DefaultSelector()
+        sel.register(self._sock, selectors.EVENT_READ)
+        sel.register(wake_rd, selectors.EVENT_READ)
+
+        while True:
+            for key,_ in sel.select():
+                if key.fileobj is self._sock:
+                    req,fds = _recv(self._sock)
+                    for fd in fds:
+                        os.close(fd)
+                    if req is None:
+                        return
+                    self._handle(req)
+                else:
+                    try:
+                        while os.read(wake_rd, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+            self._reap()
+
+    def _handle(self, req):
+        try:
+            pid,fds = self._spawn(
+                req["argv"], req["cwd"], req["env"], req.get("cpus"),
+                req.get("priority"),
+            )
+        except OSError as exc:
+            _send(self._sock, dict(
+                id=req["id"], errno=exc.errno, error=exc.strerror,
+                filename=exc.filename,
+            ))
+            return
+
+        try:
+            _send(self._sock, dict(id=req["id"], pid=pid), fds)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def _spawn(self, argv, cwd, env, cpus, priority):
+        if cwd != self._cwd:
+            os.chdir(cwd)
+            self._cwd = cwd
+
+        out_rd,out_wr = os.pipe()
+        rd_fd,wr_fd,child_wr_fd,child_rd_fd = command_pipes()
+        out_wr = move_fd_above(4, out_wr)
+
+        # all fds we create are close-on-exec; only the dup2'ed copies
+        # end up in the child
+        try:
+            pid = os.posix_spawn(
+                argv[0], argv, env,
+                file_actions=[
+                    (os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0),
+                    (os.POSIX_SPAWN_DUP2, out_wr, 1),
+                    (os.POSIX_SPAWN_DUP2, out_wr, 2),
+                    (os.POSIX_SPAWN_DUP2, child_wr_fd, 3),
+                    (os.POSIX_SPAWN_DUP2, child_rd_fd, 4),
+                ],
+                setsigdef=(signal.SIGINT, signal.SIGPIPE, signal.SIGXFSZ),
+                setpgroup=0,
+            )
+        except:
+            for fd in (out_rd, rd_fd, wr_fd):
+                os.close(fd)
+            raise
+        finally:
+            for fd in (out_wr, child_wr_fd, child_rd_fd):
+                os.close(fd)
+
+        # posix_spawn can't do these in the child; the job might run
+        # a few instructions with the defaults
+        try:
+            if cpus:
+                os.sched_setaffinity(pid, cpus)
+            if priority is not None:
+                Priority(*priority).apply(pid)
+        except OSError:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            for fd in (out_rd, rd_fd, wr_fd):
+                os.close(fd)
+            raise
+
+        fds = [out_rd, rd_fd, wr_fd]
+        if hasattr(os, "pidfd_open"):
+            try:
+                fds.append(os.pidfd_open(pid))
+            except OSError:
+                pass
+
+        return pid,fds
+
+    def _reap(self):
+        while True:
+            try:
+                pid,status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            _send(self._sock, dict(exit=pid, returncode=_exitcode(status)))
+
+class ForkServerProcess:
+    # the subset of asyncio.subprocess.Process used by the manager
+    def __init__(self, loop, pid, pidfd):
+        self._loop = loop
+        self._pidfd = pidfd
+        self._exited = loop.create_future()
+        self.pid = pid
+        self.stdout = None
+        self.returncode = None
+
+    def _set_returncode(self, returncode):
+        self.returncode = returncode
+        if self._pidfd is not None:
+            os.close(self._pidfd)
+            self._pidfd = None
+        if not self._exited.done():
+            self._exited.set_result(returncode)
+
+    async def wait(self):
+        return await asyncio.shield(self._exited)
+
+    def send_signal(self, sig):
+        if self.returncode is not None:
+            return
+        try:
+            if self._pidfd is not None:
+                signal.pidfd_send_signal(self._pidfd, sig)
+            else:
+                os.kill(self.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def signal_group(self, sig):
+        # The fork server reaps the job before we learn about it, so
+        # only the pidfd tells whether the pid still leads the job's
+        # group; it even addresses the group itself on newer kernels.
+        if self.returncode is not None:
+            return
+        try:
+            if self._pidfd is None:
+                os.killpg(self.pid, sig)
+                return
+            try:
+                signal.pidfd_send_signal(
+                    self._pidfd, sig, None, PIDFD_SIGNAL_PROCESS_GROUP
+                )
+            except OSError as exc:
+                if exc.errno != errno.EINVAL:
+                    raise
+                signal.pidfd_send_signal(self._pidfd, 0)
+                os.killpg(self.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+class ForkServer:
+    # Small helper process forked before the manager grows. Job
+    # processes are spawned by it, so spawn latency doesn't depend on
+    # the size of the manager and never blocks its event loop.
+    def __init__(self):
+        self._loop = None
+        self._sock = None
+        self._pid = None
+        self._ids = None
+        self._pending = None
+        self._procs = None
+
+    def start(self, loop):
+        ours,theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+        if (pid := os.fork()) == 0:
+            status = 0
+            try:
+                ours.close()
+                _Server(theirs).run()
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                sys.stderr.flush()
+                os._exit(status)
+
+        theirs.close()
+        ours.setblocking(False)
+
+        self._loop = loop
+        self._sock = ours
+        self._pid = pid
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._procs = {}
+        self._loop.add_reader(self._sock.fileno(), self._read)
+
+        log.debug(f"Fork server started with pid {pid}.")
+
+    def stop(self):
+        if self._sock is None:
+            return
+
+        self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        os.waitpid(self._pid, 0)
+
+        log.debug("Fork server stopped.")
+
+    async def spawn(self, argv, cwd, env, cpus=None, priority=None):
+        ident = next(self._ids)
+        fut = self._pending[ident] = self._loop.create_future()
+
+        try:
+            await self._loop.sock_sendall(self._sock, json.dumps(dict(
+                id=ident, argv=[str(arg) for arg in argv],
+                cwd=str(cwd), env=env, cpus=sorted(cpus) if cpus else None,
+                priority=None if priority is None else astuple(priority),
+            )).encode())
+            proc,out_rd,rd_fd,wr_fd = await fut
+        finally:
+            self._pending.pop(ident, None)
+
+        proc.stdout = await connect_read_fd(self._loop, out_rd)
+        return (proc, *await connect_command_fds(rd_fd, wr_fd))
+
+    def _read(self):
+        while True:
+            try:
+                msg,fds = _recv(self._sock)
+            except BlockingIOError:
+                return
+
+            if msg is None:
+                self._lost()
+                return
+
+            if "exit" in msg:
+                if (proc := self._procs.pop(msg["exit"], None)) is not None:
+                    proc._set_returncode(msg["returncode"])
+
+            elif (fut := self._pending.get(msg["id"])) is None or fut.done():
+                # requester is gone; don't leave an orphan behind
+                for fd in fds:
+                    os.close(fd)
+                if "pid" in msg:
+                    os.kill(msg["pid"], signal.SIGTERM)
+
+            elif "pid" in msg:
+                # register right away; the exit might be the very next
+                # message we read
+                out_rd,rd_fd,wr_fd,*pidfd = fds
+                proc = self._procs[msg["pid"]] = ForkServerProcess(
+                    self._loop, msg["pid"], pidfd[0] if pidfd else None,
+                )
+                fut.set_result((proc, out_rd, rd_fd, wr_fd))
+
+            else:
+                fut.set_exception(
+                    OSError(msg["errno"], msg["error"], msg["filename"])
+                )
+
+    def _lost(self):
+        log.error("Fork server exited unexpectedly.")
+
+        self._loop.remove_reader(self._sock.fileno())
+        for fut in self._pending.values():
+            if not fut.done():
+                fut.set_exception(ConnectionError("Fork server exited."))
+        for proc in self._procs.values():
+            proc._set_returncode(-1)
+        self._procs.clear()
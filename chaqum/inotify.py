@@ -0,0 +1,108 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+
+from pathlib import Path
+
+IN_ACCESS        = 0x00000001
+IN_MODIFY        = 0x00000002
+IN_ATTRIB        = 0x00000004
+IN_CLOSE_WRITE   = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN          = 0x00000020
+IN_MOVED_FROM    = 0x00000040
+IN_MOVED_TO      = 0x00000080
+IN_CREATE        = 0x00000100
+IN_DELETE        = 0x00000200
+IN_DELETE_SELF   = 0x00000400
+IN_MOVE_SELF     = 0x00000800
+IN_Q_OVERFLOW    = 0x00004000
+IN_IGNORED       = 0x00008000
+IN_ONLYDIR       = 0x01000000
+IN_ISDIR         = 0x40000000
+
+IN_MOVE = IN_MOVED_FROM | IN_MOVED_TO
+
+_EVENT = struct.Struct("iIII")
+
+def _load_libc():
+    # Linux has inotify in its libc, FreeBSD ships it as a separate
+    # library emulating it on top of kqueue
+    for name in ("c", "inotify"):
+        if (path := ctypes.util.find_library(name)) is None:
+            continue
+        try:
+            lib = ctypes.CDLL(path, use_errno=True)
+            lib.inotify_init1
+        except (OSError, AttributeError):
+            continue
+        lib.inotify_add_watch.argtypes = (
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32
+        )
+        lib.inotify_rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+        return lib
+
+_libc = _load_libc()
+
+def inotify_available():
+    return _libc is not None
+
+def _check(res):
+    if res < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return res
+
+class Inotify:
+    def __init__(self, loop, callback):
+        if _libc is None:
+            raise OSError("inotify is not available on this system.")
+
+        self._loop = loop
+        self._callback = callback
+        self._watches = {}
+        self._fd = _check(_libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC))
+        self._loop.add_reader(self._fd, self._read)
+
+    def add_watch(self, path, mask):
+        path = Path(path)
+        wd = _check(_libc.inotify_add_watch(self._fd, os.fsencode(path), mask))
+        self._watches[wd] = path
+        return wd
+
+    def rm_watch(self, wd):
+        if self._watches.pop(wd, None) is not None:
+            _libc.inotify_rm_watch(self._fd, wd)
+
+    def close(self):
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+            self._watches.clear()
+
+    def _read(self):
+        try:
+            buf = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return
+
+        pos = 0
+        while pos < len(buf):
+            wd,mask,cookie,length = _EVENT.unpack_from(buf, pos)
+            pos += _EVENT.size
+            name = os.fsdecode(buf[pos:pos + length].rstrip(b"\0"))
+            pos += length
+
+            if mask & IN_Q_OVERFLOW:
+                self._callback(None, mask, None)
+                continue
+
+            if (path := self._watches.get(wd)) is None:
+                continue
+
+            if mask & IN_IGNORED:
+                del self._watches[wd]
+
+            self._callback(path, mask, name)
@@ -1,4 +1,5 @@
 import dataclasses
+import itertools
 import json
 import os
 import shlex
@@ -39,6 +40,11 @@ def _recv_response():
     status,*rest = pipe_rd.readline().decode().strip().split(" ", 1)
     return status,rest[0] if rest else None
 
+class QueueFull(Exception):
+    # raised by enqueue(block=False) if the group has max_queued jobs
+    # waiting to start
+    pass
+
 class log:
     @staticmethod
     def critical(*args, sep=" "):
@@ -72,14 +78,14 @@ class msg:
 class job:
     ident: str
 
-    def wait(self, timeout=None):
-        if res := waitjobs(self, timeout=timeout):
+    def wait(self, timeout=None, result=False):
+        if res := waitjobs(self, timeout=timeout, result=result):
             return res[0][1]
         else:
             return job_status(False, True, None)
 
-    def kill(self, timeout=None):
-        if res := killjobs(self, timeout=timeout):
+    def kill(self, timeout=None, result=False):
+        if res := killjobs(self, timeout=timeout, result=result):
             return res[0][1]
         else:
             return job_status(False, True, None)
@@ -97,52 +103,160 @@ class job:
     def sendjson(self, obj):
         return self.sendmsg(json.dumps(obj).encode("utf-8"))
 
+@dataclasses.dataclass(frozen=True)
+class repeat:
+    ident: str
+
+    def stats(self):
+        _send_command("repeatstats", "--", self.ident)
+        status,counts = _recv_response()
+        if status != "S":
+            raise Exception()
+        return repeat_stats(*(int(count) for count in counts.split(" ")))
+
+@dataclasses.dataclass(frozen=True)
+class watcher:
+    ident: str
+
+    def unwatch(self):
+        _send_command("unwatch", "--", self.ident)
+        status,_ = _recv_response()
+        if status != "S":
+            raise Exception()
+
+    def stats(self):
+        _send_command("watchstats", "--", self.ident)
+        status,counts = _recv_response()
+        if status != "S":
+            raise Exception()
+        return watch_stats(*(int(count) for count in counts.split(" ")))
+
+@dataclasses.dataclass(frozen=True)
+class watch_stats:
+    fired: int
+    coalesced: int
+    overflows: int
+
+@dataclasses.dataclass(frozen=True)
+class repeat_stats:
+    fired: int
+    started: int
+    skipped: int
+    coalesced: int
+
+@dataclasses.dataclass(frozen=True)
+class system_stats:
+    window: float
+    samples: int
+    cpu: float
+    cpu_avg: float
+    cpu_max: float
+    mem: float
+    mem_avg: float
+    mem_max: float
+    load: float
+    load_avg: float
+    load_max: float
+
 @dataclasses.dataclass(frozen=True)
 class job_status:
     timeout: bool
     done: bool
     exitcode: int
-
-def enqueue(script, *args, group=None, max_jobs=None, max_cpu=None, forget=False):
+    result: bytes = None
+
+    def json(self):
+        return None if self.result is None else json.loads(self.result)
+
+def enqueue(script, *args, group=None, max_jobs=None, max_cpu=None,
+            cpu_window=None, env=None, label=None, rate=None, burst=None,
+            batch=None, batch_wait=None, cpus=None, nice=None, ioclass=None,
+            policy=None, max_queued=None, block=True, forget=False,
+            after=None, after_success=False, key=None, key_ttl=None,
+            timeout=None):
+    if cpus is not None and not isinstance(cpus, str):
+        cpus = ",".join(str(cpu) for cpu in cpus)
     _send_command(
         "enqueue",
         *() if group    is None else ("-g", group),
         *() if max_jobs is None else ("-m", max_jobs),
-        *() if max_cpu  is None else ("-c", max_cpu),
+        *() if max_cpu  is None else ("-c", max_cpu if cpu_window is None
+                                            else f"{max_cpu}/{cpu_window}"),
+        *() if env      is None else ("-e", shlex.join(
+            f"{name}={value}" for name,value in env.items()
+        )),
+        *() if label    is None else ("-l", label),
+        *() if rate     is None else ("-r", rate),
+        *() if burst    is None else ("-b", burst),
+        *() if batch    is None else ("-B", batch if batch_wait is None
+                                            else f"{batch}:{batch_wait}"),
+        *() if cpus     is None else ("-A", cpus),
+        *() if nice     is None else ("-N", nice),
+        *() if ioclass  is None else ("-I", ioclass),
+        *() if policy   is None else ("-P", policy),
+        *() if max_queued is None else ("-q", max_queued),
+        *() if block            else ("-Q",),
         *() if not forget       else ("-F",),
+        *() if not after        else ("-a", ",".join(j.ident for j in after)),
+        *() if not after_success else ("-s",),
+        *() if key is None      else ("-K",) if key is True else ("-k", key),
+        *() if key_ttl is None  else ("-d", key_ttl),
+        *() if timeout is None  else ("-T", timeout),
         "--",
         script, *args
     )
     status,ident = _recv_response()
+    if status == "Q":
+        raise QueueFull(group)
     if status != "S":
         raise Exception()
     return job(ident)
 
-def _repeat(script, args, *opts):
+def _repeat(script, args, overlap, jitter, spread, *opts):
     _send_command(
         "repeat",
         *opts,
+        *() if overlap is None else ("-o", overlap),
+        *() if jitter is None  else ("-j", jitter),
+        *() if spread is None  else ("-w", spread),
         "--",
         script, *args
     )
-    status,_ = _recv_response()
+    status,ident = _recv_response()
     if status != "S":
         raise Exception()
+    return repeat(ident)
 
 def interval(script, *args,
-             seconds=0, minutes=0, hours=0, days=0, weeks=0):
+             seconds=0, minutes=0, hours=0, days=0, weeks=0,
+             overlap=None, jitter=None, spread=None):
     return _repeat(
-        script, args,
+        script, args, overlap, jitter, spread,
         "-i", f"{seconds}s{minutes}m{hours}h{days}d{weeks}w",
     )
 
 def cron(script, *args,
-         second="*", minute="*", hour="*", day="*", month="*", day_of_week="*"):
+         second="*", minute="*", hour="*", day="*", month="*", day_of_week="*",
+         overlap=None, jitter=None, spread=None):
     return _repeat(
-        script, args,
+        script, args, overlap, jitter, spread,
         "-c", f"{second} {minute} {hour} {day} {month} {day_of_week}",
     )
 
+def watch(path, script, *args, events=None, debounce=None, rescan=None):
+    _send_command(
+        "watch",
+        *() if events is None   else ("-e", ",".join(events)),
+        *() if debounce is None else ("-d", debounce),
+        *() if rescan is None   else ("-r", rescan),
+        "--",
+        path, script, *args
+    )
+    status,ident = _recv_response()
+    if status != "S":
+        raise Exception()
+    return watcher(ident)
+
 def _on_items(cmd, items, timeout):
     _send_command(
         cmd,
@@ -160,22 +274,146 @@ def _on_items(cmd, items, timeout):
     for item in items:
         yield item,results.get(item.ident)
 
-def _do_jobs(func, jobs, timeout):
-    for job,result in _on_items(func, jobs, timeout):
-        if result is None:
-            yield job,None
-        elif result == "T":
-            yield job,job_status(True, None, None)
-        elif result == "N":
-            yield job,job_status(False, True, None)
-        else:
-            yield job,job_status(False, True, int(result))
+def _on_jobs_with_results(cmd, jobs, timeout):
+    _send_command(
+        cmd,
+        "-r",
+        *() if timeout is None else ("-t", timeout),
+        "--",
+        *(job.ident for job in jobs)
+    )
+    status,results = _recv_response()
+    if status != "S":
+        raise Exception()
+    statuses = dict(_read_results(results))
+    for job in jobs:
+        yield job,statuses.get(job.ident)
+
+def _read_results(results):
+    # statuses with the length of their result, which follow the status
+    # line in the same order
+    results = iter(results.split(" ") if results is not None else ())
+    statuses = []
+    for ident,result,length in zip(results, results, results):
+        data = None
+        if length != "-":
+            data = pipe_rd.read(int(length))
+            pipe_rd.read(1)
+        statuses.append((ident, _job_status(result, data)))
+    return statuses
+
+def _job_status(result, data=None):
+    if result is None:
+        return None
+    elif result == "T":
+        return job_status(True, None, None)
+    elif result == "N":
+        return job_status(False, True, None, data)
+    else:
+        return job_status(False, True, int(result), data)
+
+# completions taken by as_completed() that it wasn't asked for; the
+# manager has already forgotten about these jobs
+_completed = {}
+
+def _do_jobs(func, jobs, timeout, result):
+    stashed = {
+        job.ident: status for job in jobs
+        if (status := _completed.pop(job.ident, None)) is not None
+    }
+    remaining = [job for job in jobs if job.ident not in stashed]
+    if not remaining:
+        results = {}
+    elif result:
+        results = {
+            job.ident: status
+            for job,status in _on_jobs_with_results(func, remaining, timeout)
+        }
+    else:
+        results = {
+            job.ident: _job_status(res)
+            for job,res in _on_items(func, remaining, timeout)
+        }
+    for job in jobs:
+        yield job,stashed.get(job.ident, results.get(job.ident))
+
+def waitjobs(*jobs, timeout=None, result=False):
+    return list(_do_jobs("waitjobs", jobs, timeout, result))
+
+def killjobs(*jobs, timeout=None, result=False):
+    return list(_do_jobs("killjobs", jobs, timeout, result))
+
+def batch_items():
+    # arguments of the jobs merged into this process, one tuple per
+    # job; just our own arguments if not running a batch
+    args = sys.argv[1:]
+    if (sizes := os.environ.get("CHAQUM_BATCH")) is None:
+        return [tuple(args)]
+    items = []
+    for size in (int(size) for size in sizes.split()):
+        items.append(tuple(args[:size]))
+        args = args[size:]
+    return items
+
+def set_item_status(index, exitcode):
+    _send_command("itemstatus", "--", index, exitcode)
+    status,_ = _recv_response()
+    if status != "S":
+        raise Exception()
+
+def set_result(data):
+    # bytes are stored as they are, anything else as JSON
+    if not isinstance(data, (bytes, bytearray)):
+        data = json.dumps(data).encode("utf-8")
+    _send_command("setresult", "--", len(data), flush=False)
+    pipe_wr.write(data)
+    pipe_wr.write(b"\n")
+    pipe_wr.flush()
+    status,_ = _recv_response()
+    if status != "S":
+        raise Exception()
 
-def waitjobs(*jobs, timeout=None):
-    return list(_do_jobs("waitjobs", jobs, timeout))
+def _nextdone(limit, timeout):
+    # the manager forgets the jobs it returns, so always take their
+    # results along
+    _send_command(
+        "nextdone",
+        "-r",
+        "-n", limit,
+        *() if timeout is None else ("-t", timeout),
+    )
+    status,results = _recv_response()
+    if status == "T":
+        raise TimeoutError()
+    if status != "S":
+        raise Exception()
+    return [
+        (job(ident), status)
+        for ident,status in _read_results(results)
+    ]
 
-def killjobs(*jobs, timeout=None):
-    return list(_do_jobs("killjobs", jobs, timeout))
+def as_completed(*jobs, timeout=None, batch=100):
+    wanted = {job.ident for job in jobs}
+
+    # completions taken earlier by someone else
+    for ident in list(wanted if jobs else _completed):
+        if (status := _completed.pop(ident, None)) is not None:
+            wanted.discard(ident)
+            yield job(ident),status
+
+    while wanted or not jobs:
+        if not (done := _nextdone(batch, timeout)):
+            break
+        for child,status in done:
+            if not jobs or child.ident in wanted:
+                wanted.discard(child.ident)
+                yield child,status
+            else:
+                _completed[child.ident] = status
+
+    # not our children or already waited for otherwise
+    if wanted:
+        yield from waitjobs(*(job for job in jobs if job.ident in wanted))
 
 def waitrecv(*messages, timeout=None):
     return [
@@ -189,25 +427,188 @@ def recvmsg(timeout=None):
         *() if timeout is None else ("-t", timeout),
     )
     status,length = _recv_response()
+    if status == "T":
+        return None
+    if status != "S":
+        raise Exception()
     data = pipe_rd.read(int(length))
     pipe_rd.read(1)
     return data
 
+def recvmsgs(max=100, timeout=None):
+    # up to max messages in one go; waits for the first one only
+    _send_command(
+        "recvmsg",
+        "-n", max,
+        *() if timeout is None else ("-t", timeout),
+    )
+    status,lengths = _recv_response()
+    if status == "T":
+        return []
+    if status != "S":
+        raise Exception()
+    msgs = []
+    for length in lengths.split(" "):
+        msgs.append(pipe_rd.read(int(length)))
+        pipe_rd.read(1)
+    return msgs
+
+def sendmsgs(*messages):
+    # (job, buf) pairs sent in one go
+    _send_command(
+        "sendmsg", "--",
+        *(part for dest,buf in messages for part in (dest.ident, len(buf))),
+        flush=False,
+    )
+    for _,buf in messages:
+        pipe_wr.write(buf)
+        pipe_wr.write(b"\n")
+    pipe_wr.flush()
+    status,idents = _recv_response()
+    if status != "S":
+        raise Exception()
+    return [msg(ident) for ident in idents.split(" ")]
+
 def recvjson(timeout=None):
-    return json.loads(recvmsg(timeout=timeout).decode("utf8"))
+    if (data := recvmsg(timeout=timeout)) is None:
+        return None
+    return json.loads(data.decode("utf8"))
+
+def map(script, iterable, *args, group=None, max_jobs=None, max_cpu=None,
+        workers=None, chunksize=1, ordered=True, inflight=2):
+    # Runs script as a pool of workers (see map_worker) and streams the
+    # items of iterable to them in chunks. Only a bounded window of
+    # chunks is in flight or waiting for its turn at any time. Consumes
+    # the messages sent to the calling job while running.
+    if workers is None:
+        workers = max_jobs or os.cpu_count() or 1
+
+    it = iter(iterable)
+    chunks = enumerate(iter(lambda: list(itertools.islice(it, chunksize)), []))
+    window = workers * inflight
+
+    pool = [
+        enqueue(script, *args, group=group, max_jobs=max_jobs, max_cpu=max_cpu)
+        for _ in range(workers)
+    ]
+    busy = {worker.ident: 0 for worker in pool}
+    waiting = {}
+    next_index = 0
+    pending = 0
+    finished = False
+
+    def fill():
+        # hand out chunks to every worker with room, all in one go
+        nonlocal pending
+        outgoing = []
+        for worker in pool:
+            while busy[worker.ident] < inflight and pending < window:
+                if (chunk := next(chunks, None)) is None:
+                    break
+                index,items = chunk
+                outgoing.append(
+                    (worker, json.dumps(dict(i=index, items=items)).encode())
+                )
+                busy[worker.ident] += 1
+                pending += 1
+        if outgoing:
+            sendmsgs(*outgoing)
+
+    try:
+        fill()
+
+        while pending:
+            if not (received := recvmsgs(window, timeout=1.0)):
+                for worker,status in waitjobs(*pool, timeout=0):
+                    if status is not None and status.done:
+                        raise Exception(
+                            f"Map worker '{worker.ident}' exited early."
+                        )
+                continue
+
+            for res in (json.loads(data) for data in received):
+                # leftovers of an earlier map stopped early
+                if res["w"] not in busy:
+                    continue
+
+                if "e" in res:
+                    raise Exception(
+                        f"Map worker '{res['w']}' failed: {res['e']}"
+                    )
+
+                busy[res["w"]] -= 1
+
+                if ordered:
+                    waiting[res["i"]] = res["r"]
+                    while (results := waiting.pop(next_index, None)) is not None:
+                        next_index += 1
+                        pending -= 1
+                        yield from results
+                else:
+                    pending -= 1
+                    yield from res["r"]
+
+            fill()
+
+        sendmsgs(*((worker, b"null") for worker in pool))
+        waitjobs(*pool)
+        finished = True
+
+    finally:
+        if not finished:
+            killjobs(*pool)
+
+def map_worker(func):
+    # counterpart to map(): applies func to the items sent by the
+    # parent until told to stop
+    me = os.environ["CHAQUM_IDENT"]
+    while (req := recvjson()) is not None:
+        try:
+            res = dict(w=me, i=req["i"], r=[func(item) for item in req["items"]])
+        except Exception as exc:
+            res = dict(w=me, i=req["i"], e=repr(exc))
+        parent.sendjson(res)
+
+def stats(window=60):
+    # system metrics the job manager sampled over the last window
+    # seconds
+    _send_command("stats", "-w", window)
+    status,values = _recv_response()
+    if status != "S":
+        raise Exception()
+    window,samples,*values = values.split(" ")
+    return system_stats(
+        float(window), int(samples), *(float(value) for value in values)
+    )
+
+def reload_tree():
+    _send_command("reloadtree")
+    status,_ = _recv_response()
+    if status != "S":
+        raise Exception()
 
 if parent := os.environ.get("CHAQUM_PARENT"):
     parent = job(parent)
 
 __all__ = (
     "log",
+    "QueueFull",
     "enqueue",
     "interval",
     "cron",
+    "watch",
     "waitjobs",
     "killjobs",
+    "as_completed",
     "waitrecv",
     "recvmsg",
     "recvjson",
+    "recvmsgs",
+    "sendmsgs",
+    "set_result",
+    "batch_items",
+    "set_item_status",
+    "stats",
+    "reload_tree",
     "parent",
 )
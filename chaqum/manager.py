@@ -2,38 +2,87 @@ import asyncio
 import itertools
 import os
 import logging
+import shutil
+import signal
+import tempfile
+import time
 
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.events import EVENT_JOB_REMOVED,EVENT_ALL_JOBS_REMOVED
+from collections import OrderedDict
+from subprocess import SubprocessError
 
 from .dataclasses import (
+    Batch,
+    DependencyFailed,
     Job,
     Group,
     GroupConfig,
+    JobTombstone,
     Message,
+    QueueFull,
+    Repeat,
 )
-from .flowcontrolmixin import (
-    FlowControlMixin,
+from .forkserver import (
+    ForkServer,
+)
+from .remote import (
+    TOKEN_VAR,
+    AgentPool,
+    check_listen,
+)
+from .scheduler import (
+    schedulers,
+)
+from .scripts import (
+    ScriptCache,
+)
+from .spawn import (
+    signal_group,
+    spawn_local,
 )
 from .tasks import (
     CommandTask,
     LoggingTask,
     StatsTask,
 )
+from .tracing import (
+    Tracer,
+)
 from .util import (
-    path_is_file,
     path_is_dir,
-    path_is_executable,
-    move_fd_above,
-    get_max_fd,
+)
+from .watch import (
+    Watch,
+    Watcher,
 )
 
 log = logging.getLogger("chaqum.manager")
 
+# upper bound of remembered recently succeeded deduplication keys
+MAX_RECENT_KEYS = 4096
+
 class Manager:
-    def __init__(self, path, entry_script_name="entry"):
+    def __init__(self, path, entry_script_name="entry", scheduler="builtin",
+                 trace=None, trace_size=100000,
+                 retain_jobs=1000, retain_ttl=None, retain_tombstones=100000,
+                 result_size=1 << 20, result_spool=1 << 16, kill_grace=5.0,
+                 fork_server=False, listen=None, token=None):
         self._path = path_is_dir(path)
         self._entry_script_name = entry_script_name
+        self._scheduler = schedulers[scheduler]
+        self._trace = trace
+        self._trace_size = trace_size
+        self._retain_jobs = retain_jobs
+        self._retain_ttl = retain_ttl
+        self._retain_tombstones = retain_tombstones
+        self.result_size = result_size
+        self.result_spool = result_spool
+        self._kill_grace = kill_grace
+        self._scripts = ScriptCache(self._path)
+        self._fork_server = ForkServer() if fork_server else None
+        self._listen = listen
+        self._token = token
+        if listen is not None:
+            check_listen(listen, token)
         self._reset()
         self._check_script(entry_script_name)
 
@@ -41,41 +90,94 @@ class Manager:
     def is_done(self):
         return (                        # we are done iff
             self._loop is not None and  #  - we been started
-            not self._jobs and          #  - there are no jobs left
-            not self._sched.get_jobs()  #  - the scheduler is empty
+            not self._active and        #  - there are no jobs left
+            not self._sched and         #  - the scheduler is empty
+            not self._watches           #  - nothing is being watched
         )
 
-    def _check_done(self, evt=None):
+    def _check_done(self):
         if self.is_done:
             if not self._done.done():
                 self._done.set_result(True)
             return True
 
+    @property
+    def tracer(self):
+        return self._tracer
+
+    @property
+    def stats(self):
+        return self._stats
+
+    @property
+    def spool_dir(self):
+        # for results too large to keep in memory; created on first
+        # use and removed with its contents on shutdown
+        if self._spool_dir is None:
+            self._spool_dir = tempfile.mkdtemp(prefix="chaqum-results-")
+        return self._spool_dir
+
+    def dump_trace(self):
+        if self._tracer is not None:
+            log.info(f"Writing trace to '{self._trace}'.")
+            self._tracer.dump(self._trace)
+
     def _check_script(self, script):
-        path = self._path / script
-        path_is_file(path)
-        path_is_executable(path)
+        return self._scripts.check(script)
+
+    def reload_tree(self):
+        log.info("Reloading job tree.")
+        self._scripts.reload()
 
     async def run(self, *entry_args):
         if self._done is not None:
             raise Exception(f"{self} already running")
 
         self._loop = asyncio.get_running_loop()
+
+        # fork the helper first thing, while we are still small
+        if self._fork_server is not None:
+            self._fork_server.start(self._loop)
+            self._spawn = self._fork_server.spawn
+        else:
+            self._spawn = spawn_local
+
         self._jobs = {}
+        self._active = 0
+        self._timeouts = 0
+        self._finished = OrderedDict()
+        self._expiry = None
+        self._tombstones = OrderedDict()
         self._groups = {}
         self._messages = {}
-        self._sched = AsyncIOScheduler()
+        self._keys = {}
+        self._recent_keys = OrderedDict()
+        self._repeats = {}
+        self._watches = {}
+        self._watcher = None
+        self._sched = self._scheduler()
         self._stats = StatsTask(self._loop)
+        self._scripts.start(self._loop)
+        self._env = os.environ.copy()
+        self._env.pop(TOKEN_VAR, None)
         self._done = self._loop.create_future()
 
+        if self._listen is not None:
+            self._agents = AgentPool(self._loop, self._listen, self._token)
+            await self._agents.start()
+
+        if self._trace is not None:
+            self._tracer = Tracer(self._trace_size)
+            self._loop.add_signal_handler(signal.SIGUSR1, self.dump_trace)
+
         self._pid = itertools.count(1)
+        self._serial = 0
         self._mid = itertools.count(1)
+        self._rid = itertools.count(1)
+        self._wid = itertools.count(1)
 
         # add listener to get notified of relevant scheduler changes
-        self._sched.add_listener(
-            self._check_done,
-            EVENT_JOB_REMOVED | EVENT_ALL_JOBS_REMOVED
-        )
+        self._sched.add_listener(self._check_done)
 
         log.info("Job manager starting.")
 
@@ -95,33 +197,157 @@ class Manager:
 
         log.debug("Job manager shutting down.")
 
+        if self._timeouts:
+            log.info(f"{self._timeouts} job(s) timed out.")
+
         # cleanup
-        self._sched.shutdown(wait=False)
+        if self._expiry is not None:
+            self._expiry.cancel()
+
+        self._sched.shutdown()
+        self._scripts.stop()
+
+        if self._watcher is not None:
+            self._watcher.close()
+
+        if self._fork_server is not None:
+            self._fork_server.stop()
+
+        if self._agents is not None:
+            await self._agents.stop()
+
+        if self._spool_dir is not None:
+            shutil.rmtree(self._spool_dir, ignore_errors=True)
+
+        if self._tracer is not None:
+            self._loop.remove_signal_handler(signal.SIGUSR1)
+            self.dump_trace()
+
         self._reset()
 
         log.debug("Job manager stopped.")
 
     def _reset(self):
         self._loop = None
+        self._spawn = None
         self._jobs = None
+        self._active = 0
+        self._timeouts = 0
+        self._finished = None
+        self._expiry = None
+        self._tombstones = None
         self._groups = None
         self._messages = None
+        self._keys = None
+        self._recent_keys = None
+        self._repeats = None
+        self._watches = None
+        self._watcher = None
         self._sched = None
         self._stats = None
+        self._env = None
+        self._agents = None
+        self._tracer = None
+        self._spool_dir = None
         self._done = None
         self._pid = None
+        self._serial = None
         self._mid = None
+        self._rid = None
+        self._wid = None
+
+    def register_repeat(self, script, args, trigger, overlap=None):
+        self._check_script(script)
+
+        ident = f"rpt:{next(self._rid)}"
+        rpt = self._repeats[ident] = Repeat(ident, script, args, overlap)
+
+        # needs to be a coroutine function: APScheduler runs everything
+        # else in a thread pool
+        self._sched.add_job(self._fire_repeat, trigger, args=(rpt,))
+
+        return rpt
+
+    def get_repeat(self, ident):
+        return self._repeats.get(ident)
+
+    async def _fire_repeat(self, rpt):
+        rpt.fired += 1
+
+        if rpt.overlap is None or not rpt.is_active:
+            self._start_repeat(rpt)
+
+        elif rpt.overlap == "coalesce" and not rpt.pending:
+            rpt.pending = True
+            rpt.coalesced += 1
+            rpt.job.wait_done().add_done_callback(
+                lambda fut: self._start_deferred_repeat(rpt)
+            )
 
-    def register_repeat(self, script, args, trigger):
-        self._sched.add_job(
-            self.register_job,
-            kwargs = dict(
-                script = script,
-                args = args,
-            ),
-            trigger =trigger,
-            max_instances = 1,
+        else:
+            rpt.skipped += 1
+            log.debug(
+                f"Skipped repeat '{rpt.ident}' since job "
+                f"'{rpt.job.ident}' is still active."
+            )
+
+    def _start_repeat(self, rpt):
+        rpt.pending = False
+        rpt.job = self.register_job(rpt.script, args=rpt.args)
+        rpt.started += 1
+
+    def _start_deferred_repeat(self, rpt):
+        # runs as a callback, which has nobody to raise to; the
+        # scheduler logs failures of immediate starts the same way
+        try:
+            self._start_repeat(rpt)
+        except Exception as exc:
+            log.error(
+                f"Starting deferred run of repeat '{rpt.ident}' failed.",
+                exc_info=exc,
+            )
+
+    def register_watch(self, path, mask, script, args,
+                       debounce=0.0, rescan=None):
+        self._check_script(script)
+        if rescan is not None:
+            self._check_script(rescan)
+
+        if self._watcher is None:
+            self._watcher = Watcher(
+                self._loop, self._fire_watch, self._watch_gone
+            )
+
+        ident = f"watch:{next(self._wid)}"
+        watch = Watch(
+            ident, self._path / path, mask, script, args, debounce, rescan
         )
+        self._watcher.add(watch)
+        self._watches[ident] = watch
+
+        log.debug(f"Watching '{watch.path}' for '{script}'.")
+
+        return watch
+
+    def unregister_watch(self, watch):
+        if self._watches.pop(watch.ident, None) is None:
+            return
+        self._watcher.remove(watch)
+        self._check_done()
+
+    def get_watch(self, ident):
+        return self._watches.get(ident)
+
+    def _fire_watch(self, script, args):
+        try:
+            self.register_job(script, args=args)
+        except Exception as exc:
+            log.error(f"Couldn't enqueue '{script}' for watch: {exc}")
+
+    def _watch_gone(self, watch):
+        log.warning(f"Watched path '{watch.path}' is gone.")
+        self._watches.pop(watch.ident, None)
+        self._check_done()
 
     def register_message(self, data):
         ident = f"msg:{next(self._mid)}"
@@ -134,23 +360,73 @@ class Manager:
     def forget_message(self, msg):
         del self._messages[msg.ident]
 
+    def forget_messages(self, msgs):
+        for msg in msgs:
+            del self._messages[msg.ident]
+
     def register_job(self, script, args=[], ident=None, parent=None,
-                     forget=False, group=GroupConfig()):
+                     forget=False, group=GroupConfig(),
+                     after=(), after_success=False,
+                     key=None, key_ttl=None, timeout=None):
         self._check_script(script)
 
+        if group.label is not None and self._agents is None:
+            raise Exception(
+                f"Group label '{group.label}' given but not listening "
+                f"for agents."
+            )
+
+        # coalesce with a waiting/running or recently succeeded job
+        # having the same deduplication key
+        if key is not None and (job := self._coalesce(key)) is not None:
+            return job
+
+        # resolve dependencies; jobs are only forgotten once done, but
+        # the exit code of a forgotten one is just known if it is still
+        # remembered for its key
+        deps = []
+        for dep in after:
+            if (job := self.get_job(dep)) is None:
+                job = self._recent_job(dep)
+            if job is not None:
+                deps.append(job)
+            elif not self._was_issued(dep):
+                raise Exception(f"Unknown dependency '{dep}'.")
+            elif after_success:
+                raise Exception(
+                    f"Dependency '{dep}' was forgotten, its exit code is "
+                    f"unknown."
+                )
+
         if ident is None:
-            ident = f"{script}/{next(self._pid)}"
+            ident = self._job_ident(script)
 
         # get or create group
         if (grp := self._groups.get(group.ident)) is None:
             grp = self._groups[group.ident] = Group(
-                self._loop, self._stats, group
+                self._loop, self._stats, group, self._env
             )
 
         # create job object and register it
         job = self._jobs[ident] = grp[ident] = Job(
-            self._loop, ident, parent, script, *args
+            self._loop, ident, parent, script, *args,
+            after = tuple(deps),
+            after_success = after_success,
+            key = key,
+            key_ttl = key_ttl,
+            timeout = timeout,
+            tracer = self._tracer,
         )
+        grp.enqueued()
+
+        if key is not None:
+            self._keys[key] = job
+
+        # the parent can take completions with nextdone
+        if parent is not None and not forget:
+            parent.add_child()
+
+        self._active += 1
 
         log.debug(f"Registered job '{' '.join((script,) + args)}'.")
 
@@ -160,108 +436,391 @@ class Manager:
         # return job object
         return job
 
+    def _coalesce(self, key):
+        if (job := self._keys.get(key)) is not None:
+            log.debug(f"Coalesced with job '{job.ident}' for key '{key}'.")
+            return job
+
+        if (recent := self._recent_keys.get(key)) is not None:
+            expires,job = recent
+            if expires > self._loop.time():
+                log.debug(f"Skipped run of recently succeeded key '{key}'.")
+
+                # most likely it was waited for and forgotten since;
+                # register its record again so it can be waited for
+                if (registered := self._jobs.get(job.ident)) is not None:
+                    return registered
+                self._jobs[job.ident] = self._tombstones[job.ident] = job
+                self._trim_tombstones()
+                return job
+            del self._recent_keys[key]
+
+        return None
+
+    async def wait_queue_space(self, group, key=None, producer=None,
+                               block=True):
+        # Holds an enqueue back while the group it goes to has as many
+        # jobs waiting to start as it may have queued, or raises
+        # QueueFull if it shouldn't block. Enqueues that would be
+        # coalesced by their key never wait. Once woken, the space is
+        # reserved for the caller, which has to register its job right
+        # away.
+        if (
+            (grp := self._groups.get(group.ident)) is None
+            or not grp.is_full
+            or (key is not None and self._has_key(key))
+        ):
+            return
+
+        if not block:
+            raise QueueFull(f"Group '{grp.ident}' is full.")
+
+        # a producer giving up passes its space on to the next
+        fut = grp.wait_space()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                grp.release_space()
+            raise
+
+        # nobody is left to enqueue for if the producer was killed
+        # while waiting; a job coalesced by its key doesn't need the
+        # space either
+        if producer is not None and producer.is_done:
+            grp.release_space()
+            raise Exception(f"Job '{producer.ident}' is done.")
+        if key is not None and self._has_key(key):
+            grp.release_space()
+        else:
+            grp.claim_space()
+
+    def _job_ident(self, script):
+        self._serial = next(self._pid)
+        return f"{script}/{self._serial}"
+
+    def _was_issued(self, ident):
+        _,_,serial = ident.rpartition("/")
+        return serial.isdigit() and 0 < int(serial) <= self._serial
+
+    def _recent_job(self, ident):
+        # record of a job that succeeded with a key, even if the key
+        # expired already
+        return next(
+            (job for _,job in self._recent_keys.values() if job.ident == ident),
+            None
+        )
+
+    def _has_key(self, key):
+        if key in self._keys:
+            return True
+        recent = self._recent_keys.get(key)
+        return recent is not None and recent[0] > self._loop.time()
+
+    def _release_key(self, job):
+        if self._keys.get(job.key) is job:
+            del self._keys[job.key]
+
+        if job.key_ttl and job.exitcode == 0:
+            self._recent_keys.pop(job.key, None)
+            self._recent_keys[job.key] = (
+                self._loop.time() + job.key_ttl, JobTombstone(job)
+            )
+            while len(self._recent_keys) > MAX_RECENT_KEYS:
+                self._recent_keys.popitem(last=False)
+
+    def _retain(self, job):
+        self._finished[job.ident] = job
+        self._evict()
+
+    def _expire(self):
+        self._expiry = None
+        self._evict()
+
+    def _evict(self):
+        # replace the oldest finished jobs by tombstones
+        expires = (
+            None if self._retain_ttl is None else
+            time.monotonic() - self._retain_ttl
+        )
+        while self._finished:
+            ident,oldest = next(iter(self._finished.items()))
+            if not (
+                (self._retain_jobs is not None and
+                 len(self._finished) > self._retain_jobs) or
+                (expires is not None and oldest.finished < expires)
+            ):
+                break
+
+            del self._finished[ident]
+            oldest.drop_result()
+            self._jobs[ident] = self._tombstones[ident] = (
+                JobTombstone(oldest)
+            )
+
+        # come back when the oldest one expires, even if no other job
+        # finishes until then; a timer that turns out early because
+        # the oldest was forgotten meanwhile just sets the next one
+        if expires is not None and self._finished and self._expiry is None:
+            _,oldest = next(iter(self._finished.items()))
+            self._expiry = self._loop.call_later(
+                oldest.finished - expires, self._expire
+            )
+
+        self._trim_tombstones()
+
+    def _trim_tombstones(self):
+        # forget the least recently used tombstones
+        while len(self._tombstones) > self._retain_tombstones:
+            ident,tombstone = self._tombstones.popitem(last=False)
+            del self._jobs[ident]
+
+            # nobody could wait for its completion anymore
+            self._forget_child(tombstone)
+
     def get_job(self, ident):
+        if ident in self._tombstones:
+            self._tombstones.move_to_end(ident)
         return self._jobs.get(ident)
 
     def forget_job(self, job):
-        try:
-            del self._jobs[job.ident]
-        except:
-            pass
+        self._jobs.pop(job.ident, None)
+        self._finished.pop(job.ident, None)
+        self._tombstones.pop(job.ident, None)
+        job.drop_result()
+        self._forget_child(job)
+
+    def _forget_child(self, job):
+        # tombstones only know their parent by ident, so it isn't kept
+        # alive by them
+        if job.parent_ident is not None:
+            if (parent := self.get_job(job.parent_ident)) is not None:
+                parent.forget_child(job.ident)
 
     async def _run_job(self, job, grp, forget):
-        proc = None
+        try:
+            # wait for the jobs this one depends on
+            await job.wait_dependencies()
+
+            if grp.batch_size:
+                # run together with other jobs of the same script
+                await self._run_batched(job, grp)
+
+            else:
+                # wait for free slot
+                await grp.acquire_slot(job)
+
+                job.log.info("Starting job.")
+
+                await self._execute(job, grp)
+
+            job.log.info("Job completed.")
+
+        except asyncio.TimeoutError:
+            grp.timeouts += 1
+            self._timeouts += 1
+            job.log.warning(f"Job timed out after {job.timeout} seconds.")
+
+        except asyncio.CancelledError:
+            job.log.info("Job terminated.")
+
+        except DependencyFailed as exc:
+            job.log.info(f"Job skipped since dependency '{exc}' failed.")
+
+        except (OSError, SubprocessError) as exc:
+            # e.g. the script is missing from an agent's tree, the agent
+            # went away or the process couldn't be set up
+            job.log.error(f"Job failed: {exc}")
+
+        finally:
+            # remove from group list
+            del self._groups[grp.ident][job.ident]
+            if job.is_queued:
+                grp.dequeued()
+
+            # signal end of job
+            job.set_done()
+            self._active -= 1
+
+            # make deduplication key available again
+            if job.key is not None:
+                self._release_key(job)
+
+            # queue completion for the parent, unless nobody is left to
+            # take it
+            if not forget and job.parent is not None:
+                if not job.parent.is_done:
+                    job.parent.child_done(job)
+
+            # remove from job list if user won't guarantee that job'll
+            # be awaited; otherwise keep it subject to retention policy
+            if forget:
+                self.forget_job(job)
+            elif self._jobs.get(job.ident) is job:
+                self._retain(job)
+
+            # check if the manager is done running
+            self._check_done()
+
+    async def _execute(self, job, grp, **extra_env):
+        # prepare environment variables for child from the groups
+        # prebuilt template; agents only get the overrides
+        if grp.label is not None:
+            env = grp.env_overrides.copy()
+        else:
+            env = grp.env.copy()
+        env["CHAQUM_IDENT"] = job.ident
+        if job.parent is not None:
+            env["CHAQUM_PARENT"] = job.parent.ident
+        env.update(extra_env)
+
+        await self._run_process(job, grp, env)
+
+    async def _run_batched(self, job, grp):
+        # join the open batch for the job's script or open a new one,
+        # then wait for the batch to run
+        if (batch := grp.batches.get(job.script)) is None:
+            batch = grp.batches[job.script] = Batch(self._loop, job.script)
+            batch.timer = self._loop.call_later(
+                grp.batch_wait, self._flush_batch, grp, batch
+            )
+
+        job.batch = batch
+        batch.items.append(job)
+        job.set_waiting()
+
+        if len(batch.items) >= grp.batch_size:
+            self._flush_batch(grp, batch)
+
+        try:
+            exitcode = await asyncio.shield(batch.done)
+
+        except asyncio.CancelledError:
+            if batch.job is None:
+                batch.items.remove(job)
+                if not batch.items:
+                    batch.timer.cancel()
+                    del grp.batches[job.script]
+
+            # nobody is left waiting for the running batch
+            elif all(item is job or item.is_done for item in batch.items):
+                batch.job.terminate()
+
+            raise
+
+        job.exitcode = batch.statuses.get(batch.items.index(job), exitcode)
+
+    def _flush_batch(self, grp, batch):
+        if grp.batches.get(batch.script) is batch:
+            del grp.batches[batch.script]
+        batch.timer.cancel()
+
+        # the batch only runs with a time limit if all of its jobs
+        # have one; it inherits the parent they might share
+        timeouts = [item.timeout for item in batch.items]
+        parents = {item.parent for item in batch.items}
+
+        ident = self._job_ident(batch.script)
+        job = batch.job = grp[ident] = Job(
+            self._loop, ident, parents.pop() if len(parents) == 1 else None,
+            batch.script, *batch.args,
+            timeout = None if None in timeouts else max(timeouts),
+            tracer = self._tracer,
+        )
+        job.batch = batch
+        job.task = self._loop.create_task(self._run_batch(grp, batch))
+
+    async def _run_batch(self, grp, batch):
+        job = batch.job
 
         try:
-            # wait for free slot
             await grp.acquire_slot(job)
 
-            # prepare command pipes
-            rd_fd, child_wr_fd = os.pipe()
-            child_rd_fd, wr_fd = os.pipe()
-
-            # make sure that the child ends of the pipes lie above fd 4
-            # so that preexec_fn can simply dup2 them without worry
-            child_wr_fd = move_fd_above(4, child_wr_fd)
-            child_rd_fd = move_fd_above(4, child_rd_fd)
-
-            def preexec_fn():
-                os.dup2(child_wr_fd, 3)
-                os.dup2(child_rd_fd, 4)
-                os.closerange(5, get_max_fd())
-
-            job.log.info("Starting job.")
-
-            # prepare environment variables for child
-            env = os.environ.copy()
-            env["CHAQUM_IDENT"] = job.ident
-            if job.parent is not None:
-                env["CHAQUM_PARENT"] = job.parent.ident
-
-            # spawn child process
-            proc = await asyncio.create_subprocess_exec(
-                str(self._path / job.script),
-                *job.args,
-                stdin=asyncio.subprocess.DEVNULL,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.STDOUT,
-                close_fds=False,
-                preexec_fn=preexec_fn,
-                cwd=self._path,
-                env=env,
-            )
+            for item in batch.items:
+                if not item.is_done:
+                    item.set_running()
+                    grp.dequeued()
 
-            # close child pipe ends
-            os.close(child_rd_fd)
-            os.close(child_wr_fd)
+            job.log.info(f"Starting batch of {len(batch.items)} jobs.")
 
-            # connect pipe ends to asyncio protocols
-            rd = asyncio.StreamReader(loop=self._loop)
-            await self._loop.connect_read_pipe(
-                lambda: asyncio.StreamReaderProtocol(rd, loop=self._loop),
-                open(rd_fd, "rb", 0),
-            )
-            wr = asyncio.StreamWriter(
-                *await self._loop.connect_write_pipe(
-                    lambda: FlowControlMixin(loop=self._loop),
-                    open(wr_fd, "wb", 0),
+            await self._execute(
+                job, grp,
+                CHAQUM_BATCH = " ".join(
+                    str(len(item.args)) for item in batch.items
                 ),
-                None, self._loop
             )
 
+            job.log.info("Batch completed.")
+
+        except asyncio.TimeoutError:
+            grp.timeouts += 1
+            self._timeouts += 1
+            job.log.warning(f"Batch timed out after {job.timeout} seconds.")
+
+        except asyncio.CancelledError:
+            job.log.info("Batch terminated.")
+
+        except (OSError, SubprocessError) as exc:
+            job.log.error(f"Batch failed: {exc}")
+
+        finally:
+            del grp[job.ident]
+            job.set_done()
+            batch.done.set_result(job.exitcode)
+
+    async def _run_process(self, job, grp, env):
+        proc = None
+
+        try:
+            # spawn child process, on an agent with a matching label
+            # for labeled groups
+            if grp.label is not None:
+                proc,rd,wr = await self._agents.spawn(
+                    grp.label, job.script, list(job.args), env,
+                )
+            else:
+                proc,rd,wr = await self._spawn(
+                    (self._path / job.script, *job.args), self._path, env,
+                    cpus = job.cpus,
+                    priority = grp.priority,
+                )
+
             # start tasks to handle logging output and commands
             logtask = LoggingTask(self._loop, job, proc.stdout)
             cmdtask = CommandTask(self._loop, self, job, rd, wr)
 
             # set job to running and wait for process and tasks to exit
             job.set_running()
-            await proc.wait()
-            await logtask
-            await cmdtask
 
-            job.log.info("Job completed.")
+            async def wait():
+                await proc.wait()
+                await logtask
+                await cmdtask
+
+            try:
+                await asyncio.wait_for(wait(), job.timeout)
+            except asyncio.TimeoutError:
+                await self._kill_process(proc)
+                raise
 
         except asyncio.CancelledError:
             if proc is not None:
-                proc.terminate()
-                await proc.wait()
-
-            job.log.info("Job terminated.")
+                await self._kill_process(proc)
+            raise
 
         finally:
-            # remove from group list
-            del self._groups[grp.ident][job.ident]
-
-            # remove from job list if user won't guarantee that job'll be awaited
-            if forget:
-                self.forget_job(job)
-
             # take note of exit code or signal
             if proc is not None:
                 job.exitcode = proc.returncode
 
-            # signal end of job
-            job.set_done()
-
-        # check if the manager is done running
-        self._check_done()
+    async def _kill_process(self, proc):
+        # terminate the job's process group and kill it if the job
+        # doesn't exit within the grace period; once the job has been
+        # reaped its group can't be signaled safely anymore
+        signal_group(proc, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(proc.wait(), self._kill_grace)
+        except asyncio.TimeoutError:
+            pass
+        signal_group(proc, signal.SIGKILL)
+        await proc.wait()
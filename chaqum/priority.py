@@ -0,0 +1,62 @@
+import ctypes
+import os
+import platform
+
+from dataclasses import dataclass
+
+# ioprio_set(2) has no wrapper in Python's standard library
+_SYS_IOPRIO_SET = {
+    "x86_64":  251,
+    "i386":    289,
+    "i686":    289,
+    "aarch64": 30,
+    "armv7l":  314,
+    "ppc64le": 273,
+    "s390x":   282,
+    "riscv64": 30,
+}.get(platform.machine())
+
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_SHIFT = 13
+
+IOCLASSES = {
+    "realtime":    1,
+    "best-effort": 2,
+    "idle":        3,
+}
+
+# Linux only; None where the platform lacks the policy
+POLICIES = {
+    "batch": getattr(os, "SCHED_BATCH", None),
+    "idle":  getattr(os, "SCHED_IDLE", None),
+}
+
+# loaded up front; this is called between fork and exec
+_libc = ctypes.CDLL(None, use_errno=True)
+
+def ioprio_set(pid, ioclass, level):
+    if _SYS_IOPRIO_SET is None:
+        raise OSError("IO priorities not supported on this platform.")
+    prio = IOCLASSES[ioclass] << _IOPRIO_CLASS_SHIFT | level
+    if _libc.syscall(_SYS_IOPRIO_SET, _IOPRIO_WHO_PROCESS, pid, prio) < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+@dataclass(frozen=True)
+class Priority:
+    # scheduling settings applied to a job process at spawn; either
+    # from within the child before exec (pid 0) or from the outside
+    nice: int = None
+    ioclass: str = None
+    iolevel: int = 0
+    policy: str = None
+
+    def apply(self, pid=0):
+        if self.policy is not None:
+            os.sched_setscheduler(
+                pid, POLICIES[self.policy], os.sched_param(0)
+            )
+        if self.nice is not None:
+            os.setpriority(os.PRIO_PROCESS, pid, self.nice)
+        if self.ioclass is not None:
+            ioprio_set(pid, self.ioclass, self.iolevel)
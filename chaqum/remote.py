@@ -0,0 +1,330 @@
+import asyncio
+import hmac
+import itertools
+import json
+import logging
+import os
+import signal
+import struct
+
+from collections import deque
+
+log = logging.getLogger("chaqum.remote")
+
+# Frames exchanged between manager and agents: a header holding the
+# frame type, the channel (one per job, 0 for the connection itself)
+# and the payload length, followed by the payload. Control frames carry
+# JSON, OUTPUT, CMD and REPLY raw bytes with an empty payload signaling
+# end of stream.
+HEADER = struct.Struct("!BII")
+
+HELLO   = 1  # agent → manager: name, labels, capacity and token
+SPAWN   = 2  # manager → agent: script, arguments and environment
+STARTED = 3  # agent → manager: pid or error
+OUTPUT  = 4  # agent → manager: job's stdout/stderr
+CMD     = 5  # agent → manager: job's command pipe (fd 3)
+REPLY   = 6  # manager → agent: replies to the job (fd 4)
+EXIT    = 7  # agent → manager: exit code
+KILL    = 8  # manager → agent: signal to send
+
+# environment variable holding the shared secret agents present to
+# the manager, if not read from a file
+TOKEN_VAR = "CHAQUM_AGENT_TOKEN"
+
+def parse_address(address):
+    # anything containing a slash is a unix socket path, HOST:PORT
+    # otherwise; returns whether it is a unix socket and the keywords
+    # for asyncio's connection and server functions. Without a host
+    # only the loopback interface is used.
+    if "/" in address:
+        return True,dict(path=address)
+    host,sep,port = address.rpartition(":")
+    if not sep or not port.isdigit():
+        raise ValueError(f"Invalid address '{address}'.")
+    return False,dict(host=host.strip("[]") or "127.0.0.1", port=int(port))
+
+def read_token(path=None):
+    # the shared secret from the first line of a file, or from the
+    # environment if no file is given; None if there is none
+    if path is not None:
+        with open(path) as fp:
+            token = fp.readline().strip()
+        if not token:
+            raise ValueError(f"Token file '{path}' is empty.")
+        return token
+    return os.environ.get(TOKEN_VAR) or None
+
+def check_listen(address, token):
+    # anybody able to connect may run the jobs it is given and issue
+    # commands on their behalf; unix sockets are guarded by their file
+    # permissions, network listeners need a token
+    unix,_ = parse_address(address)
+    if not unix and token is None:
+        raise ValueError(
+            f"Listening on '{address}' requires a token (see --token-file "
+            f"and {TOKEN_VAR})."
+        )
+
+async def open_connection(address):
+    unix,kws = parse_address(address)
+    if unix:
+        return await asyncio.open_unix_connection(**kws)
+    return await asyncio.open_connection(**kws)
+
+async def read_frame(reader):
+    kind,channel,length = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return kind, channel, await reader.readexactly(length) if length else b""
+
+def write_frame(writer, kind, channel=0, payload=b""):
+    if isinstance(payload, dict):
+        payload = json.dumps(payload).encode()
+    writer.writelines((HEADER.pack(kind, channel, len(payload)), payload))
+
+class RemoteProcess:
+    # the subset of asyncio.subprocess.Process used by the manager
+    def __init__(self, agent, channel):
+        self._agent = agent
+        self._channel = channel
+        self._started = agent.loop.create_future()
+        self._exited = agent.loop.create_future()
+        self.pid = None
+        self.returncode = None
+        self.stdout = asyncio.StreamReader(loop=agent.loop)
+        self.cmd = asyncio.StreamReader(loop=agent.loop)
+
+    def _set_returncode(self, returncode):
+        self.returncode = returncode
+        for stream in (self.stdout, self.cmd):
+            if not stream.at_eof():
+                stream.feed_eof()
+        if not self._started.done():
+            self._started.set_exception(ConnectionError("Agent is gone."))
+        if not self._exited.done():
+            self._exited.set_result(returncode)
+
+    async def wait(self):
+        return await asyncio.shield(self._exited)
+
+    def send_signal(self, sig):
+        if self.returncode is None:
+            self._agent.send(KILL, self._channel, dict(signal=int(sig)))
+
+    def signal_group(self, sig):
+        # the agent signals the job's whole process group anyway
+        self.send_signal(sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+class RemoteWriter:
+    # stands in for the StreamWriter of the command reply pipe
+    def __init__(self, agent, channel):
+        self._agent = agent
+        self._channel = channel
+
+    def write(self, data):
+        if data:
+            self._agent.send(REPLY, self._channel, bytes(data))
+
+    def writelines(self, data):
+        self.write(b"".join(data))
+
+    async def drain(self):
+        await self._agent.drain()
+
+class Agent:
+    # manager side of a connected agent
+    def __init__(self, loop, reader, writer, hello):
+        self.loop = loop
+        self.name = str(hello["name"])
+        self.labels = frozenset(hello.get("labels", ())) | {self.name}
+        self.capacity = int(hello["capacity"])
+        self.running = 0
+        self._reader = reader
+        self._writer = writer
+        self._channels = itertools.count(1)
+        self._procs = {}
+
+    def __str__(self):
+        return self.name
+
+    def send(self, kind, channel, payload=b""):
+        if not self._writer.is_closing():
+            write_frame(self._writer, kind, channel, payload)
+
+    async def drain(self):
+        try:
+            await self._writer.drain()
+        except ConnectionError:
+            pass
+
+    def close(self):
+        self._writer.close()
+
+    async def spawn(self, script, args, env):
+        channel = next(self._channels)
+        proc = self._procs[channel] = RemoteProcess(self, channel)
+
+        self.send(SPAWN, channel, dict(script=script, args=args, env=env))
+        await self.drain()
+
+        try:
+            await proc._started
+        except asyncio.CancelledError:
+            proc.terminate()
+            raise
+
+        return proc, proc.cmd, RemoteWriter(self, channel)
+
+    async def run(self):
+        try:
+            while True:
+                kind,channel,payload = await read_frame(self._reader)
+
+                if (proc := self._procs.get(channel)) is None:
+                    continue
+
+                if kind == OUTPUT:
+                    if payload:
+                        proc.stdout.feed_data(payload)
+                    else:
+                        proc.stdout.feed_eof()
+
+                elif kind == CMD:
+                    if payload:
+                        proc.cmd.feed_data(payload)
+                    else:
+                        proc.cmd.feed_eof()
+
+                elif kind == STARTED:
+                    msg = json.loads(payload)
+                    if "pid" in msg:
+                        proc.pid = msg["pid"]
+                        proc._started.set_result(proc)
+                    else:
+                        del self._procs[channel]
+                        proc._started.set_exception(
+                            OSError(msg["errno"], msg["error"])
+                        )
+
+                elif kind == EXIT:
+                    del self._procs[channel]
+                    proc._set_returncode(json.loads(payload)["returncode"])
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+        finally:
+            for proc in self._procs.values():
+                proc._set_returncode(-1)
+            self._procs.clear()
+            self._writer.close()
+
+class AgentPool:
+    # Accepts agent connections and hands out their capacity to the
+    # jobs of groups targeting one of their labels, first come first
+    # served.
+    def __init__(self, loop, address, token=None):
+        self._loop = loop
+        self._address = address
+        self._token = token
+        self._server = None
+        self._agents = set()
+        self._handlers = set()
+        self._waiters = deque()
+
+    async def start(self):
+        unix,kws = parse_address(self._address)
+        if unix:
+            self._server = await asyncio.start_unix_server(self._accept, **kws)
+        else:
+            self._server = await asyncio.start_server(self._accept, **kws)
+        log.info(f"Listening for agents on '{self._address}'.")
+
+    async def stop(self):
+        self._server.close()
+        for agent in self._agents:
+            agent.close()
+        if self._handlers:
+            await asyncio.wait(self._handlers)
+        await self._server.wait_closed()
+
+    async def _accept(self, reader, writer):
+        try:
+            kind,_,payload = await read_frame(reader)
+            if kind != HELLO:
+                raise ValueError("Expected HELLO frame.")
+            hello = json.loads(payload)
+            if self._token is not None and not hmac.compare_digest(
+                str(hello.pop("token", None)).encode(), self._token.encode()
+            ):
+                raise ValueError("Invalid token.")
+            agent = Agent(self._loop, reader, writer, hello)
+        except Exception as exc:
+            log.error(f"Rejecting agent connection: {exc}")
+            writer.close()
+            return
+
+        log.info(
+            f"Agent '{agent}' connected with capacity {agent.capacity} "
+            f"and labels {', '.join(sorted(agent.labels))}."
+        )
+
+        self._agents.add(agent)
+        self._handlers.add(task := asyncio.current_task())
+        self._wake()
+
+        try:
+            await agent.run()
+        finally:
+            self._agents.discard(agent)
+            self._handlers.discard(task)
+            log.info(f"Agent '{agent}' disconnected.")
+
+    def _find(self, label):
+        return next(
+            (agent for agent in self._agents
+             if label in agent.labels and agent.running < agent.capacity),
+            None
+        )
+
+    def _wake(self):
+        # hand out capacity to the waiters in order; a waiter for a
+        # label without free capacity doesn't block the ones behind it
+        for item in list(self._waiters):
+            label,fut = item
+            if fut.done():
+                self._waiters.remove(item)
+            elif (agent := self._find(label)) is not None:
+                self._waiters.remove(item)
+                agent.running += 1
+                fut.set_result(agent)
+
+    async def _acquire(self, label):
+        # free capacity is handed out right away in _wake; so if there
+        # is some, nobody is waiting for it
+        if (agent := self._find(label)) is not None:
+            agent.running += 1
+            return agent
+
+        fut = self._loop.create_future()
+        self._waiters.append((label, fut))
+        return await fut
+
+    def _release(self, agent):
+        agent.running -= 1
+        self._wake()
+
+    async def spawn(self, label, script, args, env):
+        agent = await self._acquire(label)
+        try:
+            proc,rd,wr = await agent.spawn(script, args, env)
+        except:
+            self._release(agent)
+            raise
+
+        proc._exited.add_done_callback(lambda fut: self._release(agent))
+        return proc,rd,wr
@@ -0,0 +1,331 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import re
+import time
+
+from bisect import bisect_left
+from datetime import datetime,timedelta
+
+log = logging.getLogger("chaqum.scheduler")
+
+class IntervalTrigger:
+    def __init__(self, **kws):
+        self.kws = kws
+        self.interval = timedelta(**kws).total_seconds()
+
+        if self.interval <= 0:
+            raise Exception("Interval needs to be positive.")
+
+    def get_next_fire_time(self, previous, now):
+        if previous is None:
+            return now + self.interval
+
+        # skip over missed runs
+        missed = max(0, (now - previous) // self.interval)
+        return previous + (missed + 1) * self.interval
+
+    def to_apscheduler(self):
+        from apscheduler.triggers.interval import IntervalTrigger
+        return IntervalTrigger(**self.kws)
+
+_RE_CRON_EXPR = re.compile(
+    r"""
+        ^
+        (?: (?P<all>\*) | (?P<first>\w+) (?: -(?P<last>\w+) )? )
+        (?: /(?P<step>\d+) )?
+        $
+    """, re.X
+)
+
+_CRON_NAMES = dict(
+    month = dict(
+        (name,num) for num,name in enumerate((
+            "jan", "feb", "mar", "apr", "may", "jun",
+            "jul", "aug", "sep", "oct", "nov", "dec",
+        ), 1)
+    ),
+    day_of_week = dict(
+        (name,num) for num,name in enumerate((
+            "mon", "tue", "wed", "thu", "fri", "sat", "sun",
+        ))
+    ),
+)
+
+class CronTrigger:
+    # (name, minimum, maximum, default) in order of decreasing
+    # significance; defaults as in APScheduler
+    FIELDS = (
+        ("month",       1, 12, 1),
+        ("day",         1, 31, 1),
+        ("day_of_week", 0,  6, "*"),
+        ("hour",        0, 23, 0),
+        ("minute",      0, 59, 0),
+        ("second",      0, 59, 0),
+    )
+
+    def __init__(self, **kws):
+        self.kws = kws
+
+        # like APScheduler: fields less significant than the least
+        # significant given one default to their minimum, all others
+        # to '*'
+        given = [name for name,*_ in self.FIELDS if name in kws]
+        for name,minval,maxval,default in self.FIELDS:
+            if name in kws:
+                expr = kws[name]
+            elif given and name not in given and self._after(name, given[-1]):
+                expr = default
+            else:
+                expr = "*"
+
+            setattr(self, name, self._compile(name, str(expr), minval, maxval))
+
+    def _after(self, name, other):
+        names = [name for name,*_ in self.FIELDS]
+        return names.index(name) > names.index(other)
+
+    def _compile(self, name, exprs, minval, maxval):
+        names = _CRON_NAMES.get(name, {})
+        values = set()
+
+        def conv(val):
+            try:
+                val = names[val.lower()] if val.lower() in names else int(val)
+            except ValueError:
+                raise Exception(f"Unsupported cron expression '{exprs}'.")
+            if not minval <= val <= maxval:
+                raise Exception(f"Cron value '{val}' out of range for {name}.")
+            return val
+
+        for expr in exprs.split(","):
+            match = _RE_CRON_EXPR.match(expr.strip())
+            if match is None:
+                raise Exception(f"Unsupported cron expression '{exprs}'.")
+
+            first = minval if match["all"] else conv(match["first"])
+            if match["last"] is not None:
+                last = conv(match["last"])
+            elif match["all"] or match["step"] is not None:
+                last = maxval
+            else:
+                last = first
+
+            values.update(range(first, last + 1, int(match["step"] or 1)))
+
+        return sorted(values)
+
+    def _next_in(self, values, val):
+        idx = bisect_left(values, val)
+        return values[idx] if idx < len(values) else None
+
+    def get_next_fire_time(self, previous, now):
+        dt = datetime.fromtimestamp(int(now) + 1)
+        limit = dt.year + 5
+
+        while dt.year <= limit:
+            if dt.month not in self.month:
+                if (month := self._next_in(self.month, dt.month)) is None:
+                    dt = datetime(dt.year + 1, self.month[0], 1)
+                else:
+                    dt = datetime(dt.year, month, 1)
+                continue
+
+            if dt.day not in self.day or dt.weekday() not in self.day_of_week:
+                dt = datetime(dt.year, dt.month, dt.day) + timedelta(days=1)
+                continue
+
+            if dt.hour not in self.hour:
+                if (hour := self._next_in(self.hour, dt.hour)) is None:
+                    dt = datetime(dt.year, dt.month, dt.day) + timedelta(days=1)
+                else:
+                    dt = dt.replace(hour=hour, minute=0, second=0)
+                continue
+
+            if dt.minute not in self.minute:
+                if (minute := self._next_in(self.minute, dt.minute)) is None:
+                    dt = dt.replace(minute=0, second=0) + timedelta(hours=1)
+                else:
+                    dt = dt.replace(minute=minute, second=0)
+                continue
+
+            if dt.second not in self.second:
+                if (second := self._next_in(self.second, dt.second)) is None:
+                    dt = dt.replace(second=0) + timedelta(minutes=1)
+                else:
+                    dt = dt.replace(second=second)
+                continue
+
+            return dt.timestamp()
+
+    def to_apscheduler(self):
+        from apscheduler.triggers.cron import CronTrigger
+        return CronTrigger(**self.kws)
+
+class SpreadTrigger:
+    def __init__(self, trigger, offset=0.0, jitter=0.0):
+        self.trigger = trigger
+        self.offset = offset
+        self.jitter = jitter
+        self._base = None
+
+    # the wrapped trigger only ever sees its own unshifted fire times so
+    # neither the offset nor the jitter accumulate
+    def _next_base(self, now):
+        self._base = self.trigger.get_next_fire_time(self._base, now)
+        return self._base
+
+    def _shift(self):
+        return self.offset + random.uniform(0, self.jitter)
+
+    def get_next_fire_time(self, previous, now):
+        if (base := self._next_base(now)) is not None:
+            return base + self._shift()
+
+    def to_apscheduler(self):
+        from apscheduler.triggers.base import BaseTrigger
+
+        spread = self
+        inner = self.trigger.to_apscheduler()
+
+        # APScheduler asks more than once for the time following the
+        # same previous one, so the wrapped trigger must not advance on
+        # every call; the unshifted base of each fire time handed out
+        # is remembered instead, as the jitter can't be undone
+        class Trigger(BaseTrigger):
+            def __init__(self):
+                self.bases = {}
+
+            def get_next_fire_time(self, previous_fire_time, now):
+                base = self.bases.get(previous_fire_time)
+                if previous_fire_time is not None:
+                    self.bases = {
+                        fire: base for fire,base in self.bases.items()
+                        if fire >= previous_fire_time
+                    }
+
+                if (base := inner.get_next_fire_time(base, now)) is None:
+                    return None
+                fire = base + timedelta(seconds=spread._shift())
+                self.bases[fire] = base
+                return fire
+
+        return Trigger()
+
+# minimal scheduler keeping its entries in a heap ordered by next fire
+# time with only a single event loop timer armed for the earliest one
+class Scheduler:
+    def __init__(self):
+        self._loop = None
+        self._heap = []
+        self._seq = itertools.count()
+        self._count = 0
+        self._timer = None
+        self._listeners = []
+
+    def __len__(self):
+        return self._count
+
+    def add_listener(self, func):
+        self._listeners.append(func)
+
+    def add_job(self, func, trigger, args=()):
+        when = trigger.get_next_fire_time(None, time.time())
+        if when is None:
+            return
+        self._count += 1
+        self._push(when, (func, args, trigger))
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._arm()
+
+    def shutdown(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._loop = None
+        self._timer = None
+        self._heap.clear()
+        self._count = 0
+
+    def _push(self, when, entry):
+        heapq.heappush(self._heap, (when, next(self._seq), entry))
+
+        # only rearm the timer if the new entry is the earliest one
+        if self._heap[0][2] is entry:
+            self._arm()
+
+    def _arm(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if self._loop is not None and self._heap:
+            self._timer = self._loop.call_later(
+                max(0, self._heap[0][0] - time.time()), self._fire
+            )
+
+    def _job_done(self, task):
+        if not task.cancelled() and (exc := task.exception()) is not None:
+            log.error("Scheduled job raised an exception.", exc_info=exc)
+
+    def _fire(self):
+        self._timer = None
+        now = time.time()
+        removed = False
+
+        while self._heap and self._heap[0][0] <= now:
+            when,_,entry = heapq.heappop(self._heap)
+            func,args,trigger = entry
+            self._loop.create_task(func(*args)).add_done_callback(
+                self._job_done
+            )
+
+            if (when := trigger.get_next_fire_time(when, now)) is None:
+                self._count -= 1
+                removed = True
+            else:
+                heapq.heappush(self._heap, (when, next(self._seq), entry))
+
+        self._arm()
+
+        if removed:
+            for func in self._listeners:
+                func()
+
+# adapter for using the optional APScheduler as scheduler backend
+class APScheduler:
+    def __init__(self):
+        from apscheduler.schedulers.asyncio import AsyncIOScheduler
+        self._sched = AsyncIOScheduler()
+
+    def __len__(self):
+        return len(self._sched.get_jobs())
+
+    def add_listener(self, func):
+        from apscheduler.events import EVENT_JOB_REMOVED,EVENT_ALL_JOBS_REMOVED
+        self._sched.add_listener(
+            lambda evt: func(),
+            EVENT_JOB_REMOVED | EVENT_ALL_JOBS_REMOVED
+        )
+
+    def add_job(self, func, trigger, args=()):
+        self._sched.add_job(
+            func,
+            args = args,
+            trigger = trigger.to_apscheduler(),
+            max_instances = 1,
+        )
+
+    def start(self):
+        self._sched.start()
+
+    def shutdown(self):
+        self._sched.shutdown(wait=False)
+
+schedulers = {
+    "builtin": Scheduler,
+    "apscheduler": APScheduler,
+}
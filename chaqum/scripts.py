@@ -0,0 +1,120 @@
+import logging
+import os
+
+from .inotify import (
+    Inotify,
+    inotify_available,
+    IN_ATTRIB,
+    IN_CREATE,
+    IN_DELETE,
+    IN_DELETE_SELF,
+    IN_IGNORED,
+    IN_MODIFY,
+    IN_MOVE,
+    IN_MOVE_SELF,
+    IN_ONLYDIR,
+)
+from .util import (
+    path_is_file,
+    path_is_executable,
+)
+
+log = logging.getLogger("chaqum.scripts")
+
+_WATCH_MASK = (
+    IN_ATTRIB | IN_CREATE | IN_DELETE | IN_MODIFY | IN_MOVE |
+    IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+)
+
+def _stat_key(path):
+    st = os.stat(path)
+    return (st.st_ino, st.st_mtime_ns, st.st_ctime_ns)
+
+class ScriptCache:
+    # Remembers scripts of the job tree that have been validated as
+    # executable files. Entries are invalidated through inotify
+    # watches on the directories containing them or, where inotify is
+    # not available, by a single stat comparing inode, mtime and ctime.
+    def __init__(self, path):
+        self._path = path
+        self._cache = {}
+        self._inotify = None
+        self._watched = {}
+
+    def start(self, loop):
+        if inotify_available():
+            try:
+                self._inotify = Inotify(loop, self._invalidate)
+            except OSError as exc:
+                log.warning(f"Falling back to stat for script cache: {exc}")
+
+    def stop(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        self.reload()
+
+    def reload(self):
+        self._cache.clear()
+        self._watched.clear()
+
+    def _invalidate(self, path, mask, name):
+        # the event queue overflowed; anything might have changed
+        if path is None:
+            self.reload()
+            return
+
+        # the directory itself is gone or somewhere else now
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+            if (wd := self._watched.pop(path, None)) is not None:
+                self._inotify.rm_watch(wd)
+            changed = path
+        else:
+            changed = path / name
+
+        # The tree is the jobs' working directory too, so files come
+        # and go there all the time. Only drop the scripts that are the
+        # changed entry or below it.
+        for script,(resolved,_) in list(self._cache.items()):
+            if any(
+                changed == script_path or changed in script_path.parents
+                for script_path in (self._path / script, resolved)
+            ):
+                del self._cache[script]
+
+    def _watch(self, *dirs):
+        # returns whether all directories are watched; adding a watch
+        # fails e.g. when running out of them (ENOSPC)
+        for path in dirs:
+            if path not in self._watched:
+                try:
+                    self._watched[path] = self._inotify.add_watch(
+                        path, _WATCH_MASK
+                    )
+                except OSError as exc:
+                    log.warning(f"Falling back to stat for '{path}': {exc}")
+                    return False
+        return True
+
+    def check(self, script):
+        if (entry := self._cache.get(script)) is not None:
+            path,key = entry
+            if key is None:
+                return path
+            try:
+                if _stat_key(path) == key:
+                    return path
+            except OSError:
+                pass
+
+        path = self._path / script
+        resolved = path_is_executable(path_is_file(path))
+
+        if (self._inotify is not None and
+                self._watch(path.parent, resolved.parent)):
+            key = None
+        else:
+            key = _stat_key(resolved)
+
+        self._cache[script] = (resolved, key)
+        return resolved
@@ -0,0 +1,122 @@
+import asyncio
+import os
+
+from subprocess import SubprocessError
+
+from .flowcontrolmixin import (
+    FlowControlMixin,
+)
+from .util import (
+    get_max_fd,
+    move_fd_above,
+)
+
+def command_pipes():
+    # returns our read and write ends followed by the child's write
+    # and read ends, the latter moved above fd 4 so that they can be
+    # dup2'ed to 3 and 4 without clobbering each other
+    rd_fd, child_wr_fd = os.pipe()
+    child_rd_fd, wr_fd = os.pipe()
+    return (
+        rd_fd, wr_fd,
+        move_fd_above(4, child_wr_fd), move_fd_above(4, child_rd_fd),
+    )
+
+async def spawn_local(argv, cwd, env, cpus=None, priority=None):
+    # spawn a job process directly from the running process; returns
+    # the process and streams connected to the command pipes
+    rd_fd,wr_fd,child_wr_fd,child_rd_fd = command_pipes()
+
+    # every job leads a process group of its own, so it can be killed
+    # along with everything it started
+    def preexec_fn():
+        os.setpgid(0, 0)
+        try:
+            if cpus:
+                os.sched_setaffinity(0, cpus)
+            if priority is not None:
+                priority.apply()
+        except OSError as exc:
+            # all the parent gets is a SubprocessError; leave the
+            # reason for it in the command pipe
+            os.write(child_wr_fd, f"{exc.errno} {exc.strerror}".encode())
+            raise
+        os.dup2(child_wr_fd, 3)
+        os.dup2(child_rd_fd, 4)
+        os.closerange(5, get_max_fd())
+
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *argv,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            close_fds=False,
+            preexec_fn=preexec_fn,
+            cwd=cwd,
+            env=env,
+        )
+    except SubprocessError as exc:
+        error = preexec_error(rd_fd)
+        os.close(rd_fd)
+        os.close(wr_fd)
+        if error is None:
+            raise
+        raise error from exc
+    except:
+        os.close(rd_fd)
+        os.close(wr_fd)
+        raise
+    finally:
+        os.close(child_rd_fd)
+        os.close(child_wr_fd)
+
+    return (proc, *await connect_command_fds(rd_fd, wr_fd))
+
+def preexec_error(fd):
+    # the OSError preexec_fn left in the command pipe, if any
+    os.set_blocking(fd, False)
+    try:
+        errno,_,strerror = os.read(fd, 4096).decode().partition(" ")
+        return OSError(int(errno), strerror)
+    except (BlockingIOError, ValueError):
+        return None
+
+def signal_group(proc, sig):
+    # signal the process group led by a job process, but only as long
+    # as the leader hasn't been reaped: its pid might lead some other
+    # group afterwards. Remote processes leave this to their agent,
+    # fork server processes know better when their leader is gone.
+    if (func := getattr(proc, "signal_group", None)) is not None:
+        func(sig)
+        return
+    if proc.returncode is not None:
+        return
+    try:
+        os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+        pass
+
+async def connect_command_fds(rd_fd, wr_fd):
+    loop = asyncio.get_running_loop()
+    return (
+        await connect_read_fd(loop, rd_fd),
+        await connect_write_fd(loop, wr_fd),
+    )
+
+async def connect_read_fd(loop, fd):
+    rd = asyncio.StreamReader(loop=loop)
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(rd, loop=loop),
+        open(fd, "rb", 0),
+    )
+    return rd
+
+async def connect_write_fd(loop, fd):
+    return asyncio.StreamWriter(
+        *await loop.connect_write_pipe(
+            lambda: FlowControlMixin(loop=loop),
+            open(fd, "wb", 0),
+        ),
+        None, loop
+    )
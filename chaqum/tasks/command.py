@@ -3,9 +3,12 @@ import getopt
 import re
 import shlex
 
-from apscheduler.triggers.cron import CronTrigger
-from apscheduler.triggers.interval import IntervalTrigger
-from ..dataclasses import GroupConfig
+from ..affinity import parse_cpulist
+from ..dataclasses import GroupConfig,QueueFull
+from ..priority import IOCLASSES,POLICIES
+from ..scheduler import CronTrigger,IntervalTrigger,SpreadTrigger
+from ..util import stable_hash
+from ..watch import DEFAULT_EVENTS,parse_events
 
 _RE_INTERVAL = re.compile(
     r"""
@@ -52,6 +55,66 @@ def parse_cron(cron):
 
     raise Exception("Invalid cron specifier.")
 
+def environment(env):
+    env = [var.split("=", 1) for var in shlex.split(env)]
+    if not all(len(var) == 2 and var[0] for var in env):
+        raise ValueError()
+    return dict(env)
+
+def seconds(spec):
+    # finite and not negative
+    value = float(spec)
+    if not 0 <= value < float("inf"):
+        raise ValueError()
+    return value
+
+def rate(spec):
+    # RATE[/PERIOD] to starts per second
+    count,_,period = spec.partition("/")
+    value = float(count) / (float(period) if period else 1.0)
+    if value <= 0:
+        raise ValueError()
+    return value
+
+def batching(spec):
+    # MAXITEMS[:MAXWAIT]
+    items,_,wait = spec.partition(":")
+    items,wait = int(items), float(wait) if wait else 1.0
+    if items < 1 or wait < 0:
+        raise ValueError()
+    return items,wait
+
+def events(spec):
+    return parse_events(spec)
+
+def cpulimit(spec):
+    # MAXCPU[/WINDOW]
+    limit,_,window = spec.partition("/")
+    return float(limit), float(window) if window else 0.0
+
+def cpuspec(spec):
+    # CPU list or NUMA placement
+    if spec not in ("pack", "spread"):
+        parse_cpulist(spec)
+    return spec
+
+def ioclass(spec):
+    # CLASS[:LEVEL]; the idle class has no levels
+    name,_,level = spec.partition(":")
+    level = int(level) if level else 0 if name == "idle" else 4
+    if name not in IOCLASSES or not 0 <= level <= 7:
+        raise ValueError()
+    return name,level
+
+def policy(spec):
+    if spec not in POLICIES:
+        raise ValueError()
+    if POLICIES[spec] is None:
+        raise Exception(
+            f"Scheduling policy '{spec}' not supported on this platform."
+        )
+    return spec
+
 def opt_to_value(opts, opt, conv):
     try:
         return conv(opts[opt])
@@ -112,12 +175,18 @@ class CommandTask:
                     )
 
                 if func is not None and opts is not None:
+                    if (tracer := self.manager.tracer) is not None:
+                        start = tracer.now()
+
                     try:
                         reply = await func(self, dict(opts), *args)
 
                     except Exception as exc:
                         self.job.log.error(f"{cmd}: {exc}", exc_info=True)
 
+                    if tracer is not None:
+                        tracer.command(self.job, cmd, start)
+
                 if isinstance(reply, str):
                     reply = (reply.encode(), b"\n")
 
@@ -127,7 +196,19 @@ class CommandTask:
         except asyncio.CancelledError:
             pass
 
-    @commands.add("i:c:")
+    async def read_payload(self, length):
+        data, = await self.read_payloads(length)
+        return data
+
+    async def read_payloads(self, *lengths):
+        # payloads following a command line
+        payloads = []
+        for length in lengths:
+            payloads.append(await self.rd.readexactly(length))
+            await self.rd.readuntil()
+        return payloads
+
+    @commands.add("i:c:o:j:w:")
     async def repeat(self, opts, script, *args):
         if interval := opts.get("-i"):
             trigger = parse_interval(interval)
@@ -138,35 +219,137 @@ class CommandTask:
         else:
             raise Exception("Missing repetition specifier (-i/-c).")
 
-        self.manager.register_repeat(script, args, trigger)
+        jitter = opt_to_value(opts, "-j", seconds) or 0.0
+        window = opt_to_value(opts, "-w", seconds) or 0.0
+
+        if jitter or window:
+            # derive the offset inside the spread window from the entry
+            # itself so it is stable across restarts; in milliseconds,
+            # so windows below one leave nothing to spread
+            offset = 0.0
+            if span := int(window * 1000):
+                seed = stable_hash(interval or cron, script, *args)
+                offset = int(seed, 16) % span / 1000
+
+            trigger = SpreadTrigger(trigger, offset, jitter)
+
+        overlap = opts.get("-o")
+        if overlap not in (None, "skip", "coalesce"):
+            raise Exception(f"Invalid overlap mode '{overlap}'.")
+
+        rpt = self.manager.register_repeat(script, args, trigger, overlap)
+
+        return f"S {rpt.ident}"
+
+    @commands.add("e:d:r:")
+    async def watch(self, opts, path, script, *args):
+        if (debounce := opt_to_value(opts, "-d", float)) is None:
+            debounce = 0.5
+
+        watch = self.manager.register_watch(
+            path,
+            opt_to_value(opts, "-e", events) or parse_events(DEFAULT_EVENTS),
+            script, args,
+            debounce = debounce,
+            rescan = opts.get("-r"),
+        )
+
+        return f"S {watch.ident}"
+
+    @commands.add()
+    async def unwatch(self, opts, *idents):
+        for ident in idents:
+            if (watch := self.manager.get_watch(ident)) is not None:
+                self.manager.unregister_watch(watch)
 
         return "S"
 
-    @commands.add("Fg:m:c:")
+    @commands.add()
+    async def watchstats(self, opts, ident):
+        if (watch := self.manager.get_watch(ident)) is None:
+            raise Exception(f"Unknown watch '{ident}'.")
+
+        return f"S {watch.fired} {watch.coalesced} {watch.overflows}"
+
+    @commands.add()
+    async def repeatstats(self, opts, ident):
+        if (rpt := self.manager.get_repeat(ident)) is None:
+            raise Exception(f"Unknown repeat '{ident}'.")
+
+        return f"S {rpt.fired} {rpt.started} {rpt.skipped} {rpt.coalesced}"
+
+    @commands.add("Fg:m:c:e:l:r:b:B:A:N:I:P:q:Qa:sk:Kd:T:")
     async def enqueue(self, opts, script, *args):
         kws = dict(
             script = script,
             args = args,
             parent = self.job,
             forget = "-F" in opts,
+            timeout = opt_to_value(opts, "-T", float),
         )
 
-        if "-g" in opts:
+        if "-a" in opts:
             kws.update(
-                group = GroupConfig(
-                    **opts_to_keywords(
-                        opts,
-                        ident    = ("-g", str),
-                        max_jobs = ("-m", int),
-                        max_cpu  = ("-c", float),
-                    )
-                ),
+                after = tuple(filter(None, opts["-a"].split(","))),
+                after_success = "-s" in opts,
+            )
+
+        if "-K" in opts:
+            kws.update(key = stable_hash(script, *args))
+        elif "-k" in opts:
+            kws.update(key = opts["-k"])
+
+        if "key" in kws:
+            kws.update(key_ttl = opt_to_value(opts, "-d", float))
+
+        if "-g" in opts:
+            config = opts_to_keywords(
+                opts,
+                ident    = ("-g", str),
+                max_jobs = ("-m", int),
+                env      = ("-e", environment),
+                label    = ("-l", str),
+                rate     = ("-r", rate),
+                burst    = ("-b", int),
+                batch    = ("-B", batching),
+                cpus     = ("-A", cpuspec),
+                nice     = ("-N", int),
+                ioclass  = ("-I", ioclass),
+                policy   = ("-P", policy),
+                max_queued = ("-q", int),
             )
 
+            if (limit := opt_to_value(opts, "-c", cpulimit)) is not None:
+                config.update(max_cpu = limit[0], cpu_window = limit[1])
+
+            kws.update(group = GroupConfig(**config))
+
+            try:
+                await self.manager.wait_queue_space(
+                    kws["group"], kws.get("key"), self.job,
+                    block = "-Q" not in opts,
+                )
+            except QueueFull:
+                return "Q"
+
         job = self.manager.register_job(**kws)
 
         return f"S {job.ident}"
 
+    @commands.add("w:")
+    async def stats(self, opts):
+        window = opt_to_value(opts, "-w", float) or 60.0
+        return " ".join(
+            ["S", f"{window:g}"] +
+            [f"{value:.2f}" if isinstance(value, float) else str(value)
+             for value in self.manager.stats.summary(window)]
+        )
+
+    @commands.add()
+    async def reloadtree(self, opts):
+        self.manager.reload_tree()
+        return "S"
+
     async def _waitfutures(self, futures, timeout):
         if not futures:
             return (),()
@@ -184,21 +367,49 @@ class CommandTask:
             opt_to_value(opts, "-t", float),
         )
 
+        if "-r" not in opts:
+            for job in done:
+                self.manager.forget_job(job)
+
+            return " ".join(
+                ["S"] +
+                [f"{j.ident} T" for j in pending] +
+                [f"{j.ident} {'N' if j.exitcode is None else j.exitcode}"
+                 for j in done]
+            )
+
+        results = [None] * len(pending)
         for job in done:
+            results.append(job.get_result())
             self.manager.forget_job(job)
 
-        return " ".join(
-            ["S"] +
+        return self._with_results(
             [f"{j.ident} T" for j in pending] +
-            [f"{j.ident} N" if j.exitcode is None else f"{j.ident} {j.exitcode}"
-             for j in done]
+            [f"{j.ident} {'N' if j.exitcode is None else j.exitcode}"
+             for j in done],
+            results,
         )
 
-    @commands.add("t:")
+    def _with_results(self, statuses, results):
+        # each status is followed by the result's length and the results
+        # themselves come after the status line
+        status = " ".join(
+            ["S"] +
+            [f"{status} {'-' if res is None else len(res)}"
+             for status,res in zip(statuses, results)]
+        )
+
+        return (
+            status.encode(), b"\n",
+            *(part for res in results if res is not None
+                   for part in (res, b"\n")),
+        )
+
+    @commands.add("t:r")
     async def waitjobs(self, opts, *idents):
         return await self._waitjobs(opts, idents)
 
-    @commands.add("t:")
+    @commands.add("t:r")
     async def killjobs(self, opts, *idents):
         for ident in idents:
             if (job := self.manager.get_job(ident)) is not None:
@@ -206,18 +417,92 @@ class CommandTask:
 
         return await self._waitjobs(opts, idents)
 
+    @commands.add("t:n:r")
+    async def nextdone(self, opts):
+        if (fut := self.job.wait_child_done()) is None:
+            return "S"
+
+        _,pending = await asyncio.wait(
+            [fut],
+            timeout=opt_to_value(opts, "-t", float),
+        )
+        if pending:
+            fut.cancel()
+            return "T"
+
+        done = self.job.take_done_children(opt_to_value(opts, "-n", int) or 1)
+        # the jobs are forgotten right away, so their results have to be
+        # handed out now or never
+        results = []
+        for ident,_ in done:
+            result = None
+            if (job := self.manager.get_job(ident)) is not None:
+                if "-r" in opts:
+                    result = job.get_result()
+                self.manager.forget_job(job)
+            results.append(result)
+
+        statuses = [
+            f"{ident} {'N' if exitcode is None else exitcode}"
+            for ident,exitcode in done
+        ]
+        if "-r" not in opts:
+            return " ".join(["S"] + statuses)
+
+        return self._with_results(statuses, results)
+
+    @commands.add()
+    async def itemstatus(self, opts, index, exitcode):
+        if (batch := self.job.batch) is None or batch.job is not self.job:
+            raise Exception("Not running a batch.")
+
+        if not 0 <= (index := int(index)) < len(batch.items):
+            raise Exception(f"Invalid batch item {index}.")
+
+        batch.statuses[index] = int(exitcode)
+        return "S"
+
+    @commands.add()
+    async def setresult(self, opts, length):
+        data = await self.read_payload(int(length))
+
+        if len(data) > self.manager.result_size:
+            raise Exception(
+                f"Result of {len(data)} bytes exceeds the limit of "
+                f"{self.manager.result_size}."
+            )
+
+        self.job.set_result(
+            data, self.manager.result_spool, self.manager.spool_dir
+        )
+        return "S"
+
     @commands.add()
-    async def sendmsg(self, opts, ident, length):
-        data = await self.rd.readexactly(int(length))
-        await self.rd.readuntil()
+    async def sendmsg(self, opts, *args):
+        if not args or len(args) % 2:
+            raise Exception("Expected pairs of destination and length.")
 
-        if (job := self.manager.get_job(ident)) is None:
-            raise Exception(f"Unknown message destination '{ident}'.")
+        idents = args[0::2]
+        payloads = await self.read_payloads(*(int(arg) for arg in args[1::2]))
 
-        msg = self.manager.register_message(data)
-        msg.delivered = job.enqueue_message(msg)
+        jobs = []
+        for ident in idents:
+            if (job := self.manager.get_job(ident)) is None:
+                raise Exception(f"Unknown message destination '{ident}'.")
+            jobs.append(job)
+
+        tracer = self.manager.tracer
+        msgs = []
+
+        for job,data in zip(jobs, payloads):
+            msg = self.manager.register_message(data)
+            msg.delivered = job.enqueue_message(msg)
+            msgs.append(msg)
 
-        return f"S {msg.ident}"
+            if tracer is not None:
+                tracer.send(self.job, job, msg)
+
+        return " ".join(["S"] + [msg.ident for msg in msgs])
 
     @commands.add("t:")
     async def waitrecv(self, opts, *idents):
@@ -234,21 +519,47 @@ class CommandTask:
             [f"{m.ident} R" for m in done]
         )
 
-    @commands.add("t:")
+    @commands.add("t:n:")
     async def recvmsg(self, opts):
         fut = self.job.collect_message()
-        _,pending = await asyncio.wait(
-            [fut],
-            timeout=opt_to_value(opts, "-t", float),
-        )
+        try:
+            _,pending = await asyncio.wait(
+                [fut],
+                timeout=opt_to_value(opts, "-t", float),
+            )
+        finally:
+            # don't leave the waiter behind to swallow the next message
+            if not fut.done():
+                fut.cancel()
+
         if pending:
             return "T"
 
         msg = fut.result()
-        self.manager.forget_message(msg)
+
+        if "-n" not in opts:
+            self.manager.forget_message(msg)
+
+            if (tracer := self.manager.tracer) is not None:
+                tracer.recv(self.job, msg)
+
+            return (
+                f"S {len(msg.data)}\n".encode("ascii"),
+                msg.data,
+                b"\n",
+            )
+
+        # whatever else is queued up to the limit in the same reply
+        limit = opt_to_value(opts, "-n", int)
+        msgs = [msg] + self.job.take_messages(limit - 1)
+        self.manager.forget_messages(msgs)
+
+        if (tracer := self.manager.tracer) is not None:
+            for msg in msgs:
+                tracer.recv(self.job, msg)
 
         return (
-            f"S {len(msg.data)}\n".encode("ascii"),
-            msg.data,
+            " ".join(["S"] + [str(len(msg.data)) for msg in msgs]).encode(),
             b"\n",
+            *(part for msg in msgs for part in (msg.data, b"\n")),
         )
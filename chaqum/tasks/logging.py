@@ -1,4 +1,5 @@
 import asyncio
+import codecs
 import logging
 
 loglevel_map = {
@@ -8,6 +9,9 @@ loglevel_map = {
     "D": logging.DEBUG,
 }
 
+# longest line passed on in one piece; longer ones get split
+MAX_LINE = 65536
+
 class LoggingTask:
     def __init__(self, loop, job, rd):
         self.loop = loop
@@ -20,16 +24,39 @@ class LoggingTask:
 
     async def _run(self):
         try:
-            while line := await self.rd.readline():
-                line = line.decode().rstrip()
-
-                if len(line) > 1 and line[1] == "\x1f":
-                    lvl = loglevel_map.get(line[0], logging.INFO)
-                    line = line[2:]
-                else:
-                    lvl = logging.INFO
+            # read whatever is available and split it ourselves instead
+            # of awaiting every single line; the decoder keeps characters
+            # cut in half by a chunk boundary for the next one
+            decoder = codecs.getincrementaldecoder("utf-8")("replace")
+            rest = ""
+            while data := await self.rd.read(MAX_LINE):
+                *lines,rest = (rest + decoder.decode(data)).split("\n")
+                if len(rest) >= MAX_LINE:
+                    lines.append(rest)
+                    rest = ""
+                if lines:
+                    self._log(self._parse(lines))
 
-                self.job.log.log(lvl, line)
+            if rest := rest + decoder.decode(b"", final=True):
+                self._log(self._parse((rest,)))
 
         except asyncio.CancelledError:
             pass
+
+    def _parse(self, lines):
+        records = []
+        for line in lines:
+            line = line.rstrip()
+
+            if len(line) > 1 and line[1] == "\x1f":
+                lvl = loglevel_map.get(line[0], logging.INFO)
+                line = line[2:]
+            else:
+                lvl = logging.INFO
+
+            records.append((lvl, line))
+        return records
+
+    def _log(self, records):
+        for lvl,line in records:
+            self.job.log.log(lvl, line)
@@ -1,19 +1,83 @@
 import asyncio
+import os
 import psutil
 
+from array import array
+
+class Series:
+    # fixed size ring buffer of samples
+    __slots__ = ("_data", "_next", "_count")
+
+    def __init__(self, size):
+        self._data = array("d", bytes(8 * size))
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, value):
+        self._data[self._next] = value
+        self._next = (self._next + 1) % len(self._data)
+        self._count = min(self._count + 1, len(self._data))
+
+    def latest(self, num):
+        # the num most recent samples, oldest first
+        num = min(num, self._count)
+        end = self._next
+        if num <= end:
+            return self._data[end - num:end]
+        return self._data[len(self._data) - (num - end):] + self._data[:end]
+
+    def mean(self, num):
+        if not (values := self.latest(max(num, 1))):
+            return 0.0
+        return sum(values) / len(values)
+
+    def max(self, num):
+        return max(self.latest(max(num, 1)), default=0.0)
+
 class StatsTask:
-    def __init__(self, loop, interval=0.5):
+    # samples system metrics every interval seconds and keeps history
+    # seconds of them around
+    def __init__(self, loop, interval=0.5, history=300):
+        size = max(int(history / interval), 1)
+        self.cpu = Series(size)
+        self.mem = Series(size)
+        self.load = Series(size)
         self._update_stats()
         self._loop = loop
-        self._interval = 0.5
+        self._interval = interval
         self._waiters = {}
         self._task = loop.create_task(self._run())
 
     def __await__(self):
-        return self.task.__await__()
+        return self._task.__await__()
+
+    @property
+    def cpu_percent(self):
+        return self.cpu.mean(1)
+
+    def samples(self, window):
+        # number of samples covering the last window seconds
+        return max(int(window / self._interval), 1)
+
+    def cpu_average(self, window):
+        return self.cpu.mean(self.samples(window))
+
+    def summary(self, window):
+        # number of samples followed by the latest, average and maximum
+        # value of every metric over the last window seconds
+        num = self.samples(window)
+        values = [min(num, len(self.cpu))]
+        for series in (self.cpu, self.mem, self.load):
+            values += (series.mean(1), series.mean(num), series.max(num))
+        return values
 
     def _update_stats(self):
-        self.cpu_percent = psutil.cpu_percent()
+        self.cpu.append(psutil.cpu_percent())
+        self.mem.append(psutil.virtual_memory().percent)
+        self.load.append(os.getloadavg()[0])
 
     async def _run(self):
         try:
@@ -0,0 +1,113 @@
+import itertools
+import json
+import os
+import time
+
+from collections import deque
+
+class Tracer:
+    # events are kept as plain tuples in a ring buffer; conversion to
+    # the Chrome trace event format only happens when dumping
+    def __init__(self, size=100000):
+        self._events = deque(maxlen=size)
+        self._start = time.monotonic_ns()
+
+    def now(self):
+        return time.monotonic_ns() - self._start
+
+    def state(self, job):
+        self._events.append((
+            "state", self.now(), job.ident, job.state.name,
+            None if job.parent is None else job.parent.ident,
+        ))
+
+    def command(self, job, cmd, start):
+        self._events.append((
+            "command", start, job.ident, cmd, self.now() - start,
+        ))
+
+    def send(self, job, dest, msg):
+        self._events.append((
+            "send", self.now(), job.ident, msg.ident, dest.ident,
+        ))
+
+    def recv(self, job, msg):
+        self._events.append((
+            "recv", self.now(), job.ident, msg.ident, None,
+        ))
+
+    def to_chrome(self):
+        pid = os.getpid()
+        tids = {}
+        flows = itertools.count(1)
+        msg_flows = {}
+        last_state = {}
+        events = []
+
+        def tid(ident):
+            if (num := tids.get(ident)) is None:
+                num = tids[ident] = len(tids) + 1
+                events.append(dict(
+                    ph="M", name="thread_name", pid=pid, tid=num,
+                    args=dict(name=ident),
+                ))
+            return num
+
+        def close_state(ident, ts):
+            if (prev := last_state.pop(ident, None)) is not None:
+                state,start = prev
+                events.append(dict(
+                    ph="X", cat="state", name=state, pid=pid,
+                    tid=tid(ident), ts=start / 1000, dur=(ts - start) / 1000,
+                ))
+
+        for kind,ts,ident,what,other in self._events:
+            if kind == "state":
+                close_state(ident, ts)
+
+                if what == "DONE":
+                    events.append(dict(
+                        ph="i", cat="state", name=what, s="t", pid=pid,
+                        tid=tid(ident), ts=ts / 1000,
+                    ))
+                else:
+                    last_state[ident] = (what, ts)
+
+                # link newly created jobs to their parent
+                if what == "INIT" and other is not None:
+                    flow = next(flows)
+                    for ph,on in (("s", other), ("f", ident)):
+                        events.append(dict(
+                            ph=ph, cat="spawn", name="enqueue", id=flow,
+                            bp="e", pid=pid, tid=tid(on), ts=ts / 1000,
+                        ))
+
+            elif kind == "command":
+                events.append(dict(
+                    ph="X", cat="command", name=what, pid=pid,
+                    tid=tid(ident), ts=ts / 1000, dur=other / 1000,
+                ))
+
+            elif kind == "send":
+                flow = msg_flows[what] = next(flows)
+                events.append(dict(
+                    ph="s", cat="message", name=what, id=flow,
+                    pid=pid, tid=tid(ident), ts=ts / 1000,
+                ))
+
+            elif kind == "recv":
+                if (flow := msg_flows.pop(what, None)) is not None:
+                    events.append(dict(
+                        ph="f", cat="message", name=what, id=flow, bp="e",
+                        pid=pid, tid=tid(ident), ts=ts / 1000,
+                    ))
+
+        # close states of jobs that are still in progress
+        for ident in list(last_state):
+            close_state(ident, self.now())
+
+        return dict(traceEvents=events, displayTimeUnit="ms")
+
+    def dump(self, path):
+        with open(path, "w") as fp:
+            json.dump(self.to_chrome(), fp)
@@ -2,6 +2,7 @@ from collections import deque
 from errno import EACCES,EBADF,EEXIST,ENOENT,ENOTDIR
 from functools import wraps
 from grp import getgrnam
+from hashlib import blake2b
 from os import access,close,dup,getpid,strerror,sysconf,X_OK
 from pathlib import Path
 from platform import system as operating_system
@@ -56,6 +57,13 @@ def run_once(func, *args, **kws):
             return func(*args, **kws)
     return wrapper
 
+def stable_hash(*parts):
+    h = blake2b(digest_size=16)
+    for part in parts:
+        h.update(str(part).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
 def move_fd_above(tgt, fd):
     to_close = deque()
     while fd <= tgt:
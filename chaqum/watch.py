@@ -0,0 +1,143 @@
+import logging
+
+from pathlib import Path
+
+from .inotify import (
+    Inotify,
+    IN_ATTRIB,
+    IN_CLOSE_WRITE,
+    IN_CREATE,
+    IN_DELETE,
+    IN_IGNORED,
+    IN_MODIFY,
+    IN_MOVED_FROM,
+    IN_MOVED_TO,
+)
+
+log = logging.getLogger("chaqum.watch")
+
+EVENTS = {
+    "create":      IN_CREATE,
+    "modify":      IN_MODIFY,
+    "close_write": IN_CLOSE_WRITE,
+    "attrib":      IN_ATTRIB,
+    "delete":      IN_DELETE,
+    "moved_from":  IN_MOVED_FROM,
+    "moved_to":    IN_MOVED_TO,
+}
+
+DEFAULT_EVENTS = "close_write,moved_to"
+
+def parse_events(spec):
+    mask = 0
+    for name in spec.split(","):
+        if name not in EVENTS:
+            raise ValueError()
+        mask |= EVENTS[name]
+    return mask
+
+class Watch:
+    # Runs script for every path below a watched directory (or the
+    # watched file itself) once events for it stopped coming in for
+    # debounce seconds. If events were lost, rescan is run with the
+    # watched path instead.
+    def __init__(self, ident, path, mask, script, args,
+                 debounce=0.0, rescan=None):
+        self.ident = ident
+        self.path = Path(path)
+        self.mask = mask
+        self.script = script
+        self.args = args
+        self.debounce = debounce
+        self.rescan = rescan or script
+        self.pending = {}
+        self.fired = 0
+        self.coalesced = 0
+        self.overflows = 0
+
+class Watcher:
+    # all watches of a manager on a single inotify instance
+    def __init__(self, loop, enqueue, gone):
+        self._loop = loop
+        self._enqueue = enqueue
+        self._gone = gone
+        self._inotify = Inotify(loop, self._event)
+        self._paths = {}
+        self._wds = {}
+
+    def close(self):
+        for watches in self._paths.values():
+            for watch in watches:
+                self._cancel_pending(watch)
+        self._paths.clear()
+        self._wds.clear()
+        self._inotify.close()
+
+    def add(self, watch):
+        # a second watch on the same path replaces the kernel's mask,
+        # so it has to cover all of them
+        watches = self._paths.get(watch.path, [])
+        mask = watch.mask
+        for other in watches:
+            mask |= other.mask
+        self._wds[watch.path] = self._inotify.add_watch(watch.path, mask)
+        self._paths[watch.path] = watches + [watch]
+
+    def remove(self, watch):
+        self._cancel_pending(watch)
+        if (watches := self._paths.get(watch.path)) is None:
+            return
+        watches.remove(watch)
+        if not watches:
+            del self._paths[watch.path]
+            self._inotify.rm_watch(self._wds.pop(watch.path))
+
+    def _cancel_pending(self, watch):
+        for handle in watch.pending.values():
+            handle.cancel()
+        watch.pending.clear()
+
+    def _event(self, path, mask, name):
+        # the kernel's queue overflowed; we don't know what we missed
+        if path is None:
+            for watches in self._paths.values():
+                for watch in watches:
+                    self._overflow(watch)
+            return
+
+        if mask & IN_IGNORED:
+            self._wds.pop(path, None)
+            for watch in self._paths.pop(path, ()):
+                self._cancel_pending(watch)
+                self._gone(watch)
+            return
+
+        changed = path / name if name else path
+        for watch in self._paths.get(path, ()):
+            if mask & watch.mask:
+                self._schedule(watch, changed)
+
+    def _schedule(self, watch, changed):
+        if (handle := watch.pending.pop(changed, None)) is not None:
+            handle.cancel()
+            watch.coalesced += 1
+
+        if watch.debounce:
+            watch.pending[changed] = self._loop.call_later(
+                watch.debounce, self._fire, watch, changed
+            )
+        else:
+            self._fire(watch, changed)
+
+    def _fire(self, watch, changed):
+        watch.pending.pop(changed, None)
+        watch.fired += 1
+        self._enqueue(watch.script, (*watch.args, str(changed)))
+
+    def _overflow(self, watch):
+        log.warning(
+            f"Events for '{watch.path}' were lost; running '{watch.rescan}'."
+        )
+        self._cancel_pending(watch)
+        watch.overflows += 1
+        self._enqueue(watch.rescan, (*watch.args, str(watch.path)))
@@ -22,15 +22,18 @@ setup(
     license_files=["LICENSE"],
     python_requires=">= 3.8",
     install_requires=[
-        "APScheduler >= 3.0, < 4.0",
         "python-daemon >= 2.0.6",
         "noblklog >= 0.3",
         "psutil",
     ],
+    extras_require={
+        "apscheduler": [ "APScheduler >= 3.0, < 4.0" ],
+    },
     packages=find_packages(),
     entry_points = {
         "console_scripts": [
             "chaqum=chaqum.cmdline:main",
+            "chaqum-agent=chaqum.agent:main",
         ],
     },
     package_data={